@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+# -*- encoding=utf8 -*-
+#
+# Author 2011 Hsin-Yi Chen
+"""Benchmarks of ucltip hot paths
+
+usage:
+
+    python bench_all.py [-o results.json] [-b baseline.json] [benchmark name ...]
+
+results are written as JSON with -o, and compared with the results of a
+previous run with -b, the exit status is 1 if any metric is worse than the
+baseline by more than the threshold.
+
+bench_baseline.json is the reference results of the tree before a change,
+timings depend on the machine, so make your own baseline from a clean
+checkout before comparing, and commit it again when a change is expected to
+make things faster or slower:
+
+    git stash; python bench_all.py -p 5 -o bench_baseline.json; git stash pop
+    python bench_all.py -b bench_baseline.json
+
+with -b, benchmarks run in 5 new interpreters and the best values are
+compared, as timings of micro benchmarks change with the memory layout of
+the interpreter, and those benchmarks reporting usec are allowed to change
+by 50%. a virtual or busy machine may need more processes with -p.
+
+bench_baseline.json in the tree was made on a 1 CPU virtual machine with
+python 2.7.
+"""
+import os
+import gc
+import sys
+import json
+import time
+import platform
+import argparse
+import itertools
+import tempfile
+import py_compile
+from timeit import default_timer
+import ucltip
+from test_all import setup_testenv
+
+MB = 1024 * 1024
+
+# runs of micro benchmarks, the best one is taken, a few runs of about 80 ms
+# are not enough to keep the noise under the threshold
+REPEAT = 15
+
+def timeit(func, repeat=1):
+    """run func repeat times and return the best wall time in seconds, the
+       garbage collector is disabled like the timeit module does, its cost
+       depends on objects left by other benchmarks
+    """
+    best = None
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = default_timer()
+            func()
+            elapsed = default_timer() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        if enabled:
+            gc.enable()
+    return best
+
+def bench_import(count=10):
+    """import time of ucltip in a new interpreter, by -X importtime if it is available"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    python = ucltip.Cmd(sys.executable)
+    # measure import of cached byte code
+    py_compile.compile(os.path.join(root, 'ucltip', '__init__.py'))
+    code = 'import sys, time; sys.path.insert(0, {0!r}); start = time.time(); ' \
+           'import ucltip; print(time.time() - start)'.format(root)
+    result = {'wall msec': min(float(python('-c', code)) for i in range(count)) * 1e3}
+    if sys.version_info >= (3, 7):
+        def importtime():
+            with tempfile.TemporaryFile() as f:
+                python('-X', 'importtime', '-c', code, stderr_to=f)
+                f.seek(0)
+                # the last line is ucltip: self | cumulative | name
+                return int(f.read().splitlines()[-1].split(b'|')[1])
+        result['importtime msec'] = min(importtime() for i in range(count)) / 1e3
+    return result
+
+def bench_large_output(size=256 * MB):
+    """throughput of a command writes size bytes on stdout and stderr"""
+    sh = ucltip.Cmd('sh')
+    script = 'head -c {0} /dev/zero >&2 & head -c {0} /dev/zero; wait'.format(size)
+    elapsed = timeit(lambda: sh('-c', script))
+    return {'bytes': 2 * size,
+            'seconds': elapsed,
+            'MB/s': 2 * size / MB / elapsed}
+
+def bench_cmd_construction(count=10000):
+    """cost of constructing Cmd and CmdDispatcher objects"""
+    resolver = ucltip.path_resolver
+    hits, misses = resolver.hits, resolver.misses
+    cmd = timeit(lambda: [ucltip.Cmd('ls') for i in range(count)])
+    cmdd = timeit(lambda: [ucltip.CmdDispatcher('ucltip-apt-get') for i in range(count)])
+    return {'Cmd usec': cmd / count * 1e6,
+            'CmdDispatcher usec': cmdd / count * 1e6,
+            'resolver hits': resolver.hits - hits,
+            'resolver misses': resolver.misses - misses}
+
+def bench_cmdexists(count=10000):
+    """cost of checking a command exists with warm and cold PATH cache"""
+    resolver = ucltip.path_resolver
+    warm = timeit(lambda: [ucltip.cmdexists('ls') for i in range(count)], REPEAT)
+    missing = timeit(lambda: [ucltip.cmdexists('ucltip-no-such-cmd') for i in range(count)], REPEAT)
+    def cold():
+        for i in range(count // 100):
+            resolver.reset()
+            ucltip.cmdexists('ls')
+    cold = timeit(cold, REPEAT)
+    resolver.reset()
+    return {'warm usec': warm / count * 1e6,
+            'missing usec': missing / count * 1e6,
+            'cold usec': cold / (count // 100) * 1e6}
+
+def _object_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def bench_subcmd(count=100000):
+    """memory of command objects and cost of getting a sub command"""
+    cmd = ucltip.Cmd('ls')
+    cmdd = ucltip.CmdDispatcher('ucltip-apt-get')
+    subcmd = cmdd.install
+    cached = timeit(lambda: [cmdd.install for i in range(count)], REPEAT)
+    def new_names():
+        for i in range(count // 10):
+            cmdd.getsubcmd('sub{0}'.format(i))
+        cmdd._subcmds.clear()
+    created = timeit(new_names, REPEAT)
+    return {'Cmd bytes': _object_size(cmd) + _object_size(cmd.conf) + _object_size(cmd.conf.default_opts),
+            'SubCmd bytes': _object_size(subcmd),
+            'cached access usec': cached / count * 1e6,
+            'new access usec': created / (count // 10) * 1e6}
+
+def bench_transform_kwargs(count=10000):
+    """cost of OptionCreator.transform_kwargs with boolean, key-value and list options"""
+    result = {}
+    for style in ('posix', 'gnu'):
+        creator = ucltip.OptionCreator(style)
+        kwargs = {'a': True, 'b': False, 'long_name': 'value', 'n': 3,
+                  'exclude': ['x', 'y', 'z']}
+        elapsed = timeit(lambda: [creator.transform_kwargs(**kwargs) for i in range(count)], REPEAT)
+        result['{0} usec'.format(style)] = elapsed / count * 1e6
+    return result
+
+def _executables(count, exclude=()):
+    """get names of count commands in PATH, which are valid python names"""
+    names = set()
+    for path in os.environ['PATH'].split(os.pathsep):
+        if not os.path.isdir(path):
+            continue
+        for name in os.listdir(path):
+            ident = ucltip.undashify(name)
+            path_name = os.path.join(path, name)
+            if ident.replace('_', '').isalnum() and ident not in exclude \
+               and os.path.isfile(path_name) and os.access(path_name, os.X_OK):
+                names.add(name)
+    return sorted(names)[:count]
+
+def bench_regcmds(count=100):
+    """startup cost of registering many commands with regcmds, eagerly and lazily"""
+    try:
+        import __builtin__ as builtins
+    except ImportError:
+        import builtins
+    names = _executables(count, builtins.__dict__)
+    def register(lazy):
+        ucltip.path_resolver.reset()
+        ucltip.regcmds(*names, lazy=lazy)
+    saved = dict((ucltip.undashify(name), builtins.__dict__.get(ucltip.undashify(name)))
+                 for name in names)
+    try:
+        eager = timeit(lambda: register(False), REPEAT)
+        lazy = timeit(lambda: register(True), REPEAT)
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                builtins.__dict__.pop(name, None)
+            else:
+                builtins.__dict__[name] = value
+    return {'commands': len(names),
+            'eager msec': eager * 1e3,
+            'lazy msec': lazy * 1e3}
+
+def bench_make_callargs(count=10000):
+    """cost of building command arguments with 0, 5 and 50 options"""
+    result = {}
+    cmd = ucltip.Cmd('ls')
+    for n in (0, 5, 50):
+        kwargs = dict(('opt_{0}'.format(i), i) for i in range(n))
+        cmd.reset()
+        elapsed = timeit(lambda: [cmd.make_callargs('a', **kwargs) for i in range(count)], REPEAT)
+        result['{0} opts usec'.format(n)] = elapsed / count * 1e6
+        cmd.opts(**kwargs)
+        elapsed = timeit(lambda: [cmd.make_callargs('a') for i in range(count)], REPEAT)
+        result['{0} default opts usec'.format(n)] = elapsed / count * 1e6
+    return result
+
+def bench_plan(count=10000, nopts=5):
+    """building command arguments of a sub command on every call versus a bound plan"""
+    cmdd = ucltip.CmdDispatcher('ucltip-apt-get')
+    cmdd.opts(**dict(('opt_{0}'.format(i), i) for i in range(nopts)))
+    plan = cmdd.install.bind(ucltip.Placeholder('pkg'), t='maverick')
+    with ucltip.config(execmode='list'):
+        call = timeit(lambda: [cmdd.install('vim', t='maverick') for i in range(count)], REPEAT)
+        run = timeit(lambda: [plan.run('vim') for i in range(count)], REPEAT)
+    return {'call usec': call / count * 1e6,
+            'plan usec': run / count * 1e6,
+            'speedup': call / run}
+
+def bench_map(count=200, max_workers=8):
+    """executing a command for many items, sequential loop versus Cmd.map"""
+    sleep = ucltip.Cmd('sleep')
+    items = ['0.01'] * count
+    seq = timeit(lambda: [sleep(item) for item in items])
+    par = timeit(lambda: sleep.map(items, max_workers=max_workers))
+    return {'sequential seconds': seq,
+            'map seconds': par,
+            'speedup': seq / par}
+
+def bench_spawn(count=50, sizes=(0, 256, 1024)):
+    """spawn latency of default and fast spawn strategies against parent RSS in MB"""
+    true = ucltip.Cmd('true')
+    spawn = ucltip.global_config('spawn')
+    result = {}
+    try:
+        for size in sizes:
+            ballast = bytearray(size * MB)
+            for strategy in ('default', 'fast'):
+                ucltip.global_config(spawn=strategy)
+                elapsed = timeit(lambda: [true() for i in range(count)], REPEAT)
+                result['{0} {1}MB usec'.format(strategy, size)] = elapsed / count * 1e6
+            del ballast
+    finally:
+        ucltip.global_config(spawn=spawn)
+    return result
+
+def bench_resources(count=50, size=1024):
+    """spawn latency with resource controls applied in the child or by wrapper
+       commands, against a parent of size MB"""
+    true = ucltip.Cmd('true')
+    resources = ucltip.Resources(cpu=60, nofile=1024, nice=5)
+    result = {}
+    ballast = bytearray(size * MB)
+    for strategy in ('default', 'fast'):
+        with ucltip.config(spawn=strategy):
+            elapsed = timeit(lambda: [true() for i in range(count)], REPEAT)
+            result['{0} usec'.format(strategy)] = elapsed / count * 1e6
+            elapsed = timeit(lambda: [true(resources=resources) for i in range(count)], REPEAT)
+            result['{0} resources usec'.format(strategy)] = elapsed / count * 1e6
+    del ballast
+    return result
+
+def bench_pipe(size=1024 * MB):
+    """throughput of a pipe has 5 commands"""
+    def run():
+        pipe = ucltip.Pipe()
+        pipe.add('head', '-c', size, '/dev/zero')
+        for i in range(3):
+            pipe.add('cat')
+        pipe.add('wc', '-c')
+        pipe.wait()
+    elapsed = timeit(run)
+    return {'bytes': size,
+            'seconds': elapsed,
+            'MB/s': size / MB / elapsed}
+
+def bench_config(count=100000):
+    """cost of reading configure globally and in nested config scopes"""
+    result = {}
+    result['global usec'] = timeit(lambda: [ucltip.current_config() for i in range(count)], REPEAT) / count * 1e6
+    with ucltip.config(execmode='list'):
+        with ucltip.config(dry_run=True):
+            elapsed = timeit(lambda: [ucltip.current_config() for i in range(count)], REPEAT)
+            result['scope usec'] = elapsed / count * 1e6
+            ls = ucltip.Cmd('ls')
+            elapsed = timeit(lambda: [ls(a=True) for i in range(count // 10)], REPEAT)
+            result['dry run call usec'] = elapsed / (count // 10) * 1e6
+    return result
+
+def bench_debug_log(count=1000000):
+    """cost of a debug log call when debug is disabled"""
+    cmd = ucltip.Cmd('ls')
+    DBG = ucltip.DBG
+    # no list is built, its allocation costs more than the call
+    def calls():
+        for i in itertools.repeat(None, count):
+            DBG('Created a %r', cmd)
+    def empty():
+        for i in itertools.repeat(None, count):
+            pass
+    elapsed = timeit(calls, REPEAT)
+    return {'DBG usec': (elapsed - timeit(empty, REPEAT)) / count * 1e6}
+
+def bench_hooks(count=200):
+    """execute latency without hooks and with a StatsCollector"""
+    true = ucltip.Cmd('true')
+    collector = ucltip.StatsCollector()
+    without = timeit(lambda: [true() for i in range(count)], REPEAT)
+    ucltip.add_hook(collector)
+    try:
+        with_hook = timeit(lambda: [true() for i in range(count)], REPEAT)
+    finally:
+        ucltip.remove_hook(collector)
+    return {'no hook usec': without / count * 1e6,
+            'StatsCollector usec': with_hook / count * 1e6}
+
+def bench_coprocess(count=1000):
+    """latency of a request to a persistent sh against spawning echo per call"""
+    echo = ucltip.Cmd('echo')
+    framing = ucltip.SentinelFraming('echo __END__', '__END__')
+    spawn = timeit(lambda: [echo('x') for i in range(count)])
+    with ucltip.Coprocess('sh', framing=framing) as sh:
+        coproc = timeit(lambda: [sh.request('echo x') for i in range(count)])
+    return {'spawn usec': spawn / count * 1e6,
+            'coprocess usec': coproc / count * 1e6}
+
+def bench_batch_shell(count=300):
+    """running an external command by spawning it, via_shell and BatchShell, and
+       rendering a command string"""
+    expr = ucltip.Cmd('expr')
+    devnull = open(os.devnull, 'w')
+    stdout = os.dup(1)
+    spawn = timeit(lambda: [expr(1, '+', 1) for i in range(count)])
+    # output of os.system is not captured
+    os.dup2(devnull.fileno(), 1)
+    try:
+        shell = timeit(lambda: [expr(1, '+', 1, via_shell=True) for i in range(count)])
+    finally:
+        os.dup2(stdout, 1)
+        os.close(stdout)
+        devnull.close()
+    with ucltip.BatchShell() as sh:
+        batch = timeit(lambda: [sh.run(expr, 1, '+', 1) for i in range(count)])
+    argv = ['grep', '-r', '--include', '*.py', 'a pattern', "it's"]
+    render = timeit(lambda: [ucltip.render_command(argv) for i in range(10000)], REPEAT)
+    return {'spawn usec': spawn / count * 1e6,
+            'via_shell usec': shell / count * 1e6,
+            'batch usec': batch / count * 1e6,
+            'render usec': render / 10000 * 1e6}
+
+BENCHMARKS = [bench_import, bench_large_output, bench_cmdexists, bench_cmd_construction,
+              bench_subcmd, bench_transform_kwargs, bench_make_callargs, bench_plan,
+              bench_regcmds, bench_map, bench_spawn, bench_resources, bench_pipe, bench_config,
+              bench_debug_log, bench_hooks, bench_coprocess, bench_batch_shell]
+
+def direction(metric):
+    """get which direction of a metric is better
+
+    @return int -1 if lower is better, 1 if higher is better, 0 if the
+                metric is not a performance number
+    """
+    if metric.endswith(('usec', 'msec', 'seconds')):
+        return -1
+    if metric.endswith(('MB/s', 'speedup')):
+        return 1
+    return 0
+
+def compare(results, baseline, threshold, micro_threshold=None):
+    """compare results with baseline
+
+    @param dict results {benchmark: {metric: value}}
+    @param dict baseline results of a previous run
+    @param float threshold allowed relative change in the worse direction
+    @param float micro_threshold allowed relative change of benchmarks
+                                 reporting usec, which vary more between
+                                 runs, threshold is used if it is None
+    @return list (benchmark, metric, baseline value, value, change) of
+                 regressions
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        micro = micro_threshold is not None and \
+            any(metric.endswith('usec') for metric in result)
+        allowed = micro and micro_threshold or threshold
+        for metric, value in sorted(result.items()):
+            old = baseline.get(name, {}).get(metric)
+            sign = direction(metric)
+            if not old or not sign:
+                continue
+            change = (value - old) / float(old)
+            regressed = change * sign < -allowed
+            print('{0}: {1} {2:.4g} -> {3:.4g} ({4:+.1%}){5}'.format(
+                name, metric, old, value, change, regressed and ' REGRESSION' or ''))
+            if regressed:
+                regressions.append((name, metric, old, value, change))
+    return regressions
+
+def best_of(runs):
+    """merge results of many runs, the best value of every metric is kept
+
+    @param list runs results of every run, {benchmark: {metric: value}}
+    @return dict merged results
+    """
+    merged = {}
+    for results in runs:
+        for name, result in results.items():
+            best = merged.setdefault(name, {})
+            for metric, value in result.items():
+                old = best.get(metric)
+                if old is None or (value - old) * direction(metric) > 0:
+                    best[metric] = value
+    return merged
+
+def _print_result(name, result):
+    print('{0}: {1}'.format(name, ', '.join(
+        '{0}={1:.4g}'.format(k, v) for k, v in sorted(result.items()))))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks of ucltip hot paths')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all by default')
+    parser.add_argument('-o', '--output', help='write results to a JSON file')
+    parser.add_argument('-b', '--baseline', help='compare with results in a JSON file')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                        help='allowed relative regression, 0.2 by default')
+    parser.add_argument('-m', '--micro-threshold', type=float, default=0.5,
+                        help='allowed relative regression of benchmarks reporting usec, '
+                             '0.5 by default')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='run benchmarks in this number of new interpreters one by '
+                             'one and keep the best value of every metric, 5 by default '
+                             'with -b, otherwise 1')
+    args = parser.parse_args(argv)
+    processes = args.processes or (args.baseline and 5 or 1)
+    if processes > 1:
+        # timings of micro benchmarks vary with memory layout of the
+        # interpreter, which only changes between processes
+        python = ucltip.Cmd(sys.executable)
+        runs = []
+        for i in range(processes):
+            with tempfile.NamedTemporaryFile(suffix='.json') as f:
+                python(os.path.abspath(__file__), '-o', f.name, *args.names)
+                runs.append(json.load(open(f.name))['results'])
+        results = best_of(runs)
+        for name, result in sorted(results.items()):
+            _print_result(name, result)
+    else:
+        results = {}
+        for bench in BENCHMARKS:
+            name = bench.__name__[len('bench_'):]
+            if args.names and name not in args.names:
+                continue
+            results[name] = result = bench()
+            _print_result(name, result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'time': time.time(),
+                       'results': results}, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold, args.micro_threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    setup_testenv()
+    sys.exit(main(sys.argv[1:]))
@@ -3,6 +3,12 @@
 #
 # Author 2011 Hsin-Yi Chen
 import os
+import sys
+import logging
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import ucltip
 
@@ -73,6 +79,38 @@ class UtilsTestCase(unittest.TestCase):
         self.assertRaises(ucltip.NotValideOptStyle, ucltip.make_optargs, 'colum', ('first','second'), 0)
         self.assertRaises(ucltip.NotValideOptStyle, ucltip.make_optargs, 'colum', ('first','second'), 1)
 
+    def test_lrucache(self):
+        cache = ucltip.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEquals(1, cache.get('a'))
+        cache['c'] = 3
+        self.assertEquals(None, cache.get('b'))
+        self.assertEquals(1, cache.get('a'))
+        self.assertEquals(2, len(cache))
+
+    def test_shell_quote(self):
+        """test arguments are quoted as one word of shell"""
+        self.assertEquals("''", ucltip.shell_quote(''))
+        self.assertEquals('-t', ucltip.shell_quote('-t'))
+        self.assertEquals("'a b'", ucltip.shell_quote('a b'))
+        self.assertEquals("'it'\"'\"'s'", ucltip.shell_quote("it's"))
+        self.assertEquals("'$HOME'", ucltip.shell_quote('$HOME'))
+        self.assertEquals('"$HOME/a b"', ucltip.shell_quote('$HOME/a b', expand=True))
+        self.assertEquals(r'"\\\"\`"', ucltip.shell_quote(r'\"`', expand=True))
+        self.assertEquals("echo 'a b' c", ucltip.render_command(['echo', 'a b', 'c']))
+        self.assertTrue(ucltip.render_command(['a', 'b c']) is ucltip.render_command(['a', 'b c']))
+
+    def test_default_optargs(self):
+        """test command options of default options are updated after changes"""
+        opts = ucltip.DefaultOptions(a=True)
+        self.assertEquals(['-a'], opts.optargs('posix'))
+        self.assertTrue(opts.optargs('posix') is opts.optargs('posix'))
+        opts['key'] = 1
+        self.assertEquals(['--key=1'], opts.optargs('gnu', ('a',)))
+        opts.pop('key')
+        self.assertEquals(['-a'], opts.optargs('gnu'))
+
     def test_cmdexist(self):
         """check commands exists """
         self.assertFalse(ucltip.cmdexists(None))
@@ -87,6 +125,73 @@ class UtilsTestCase(unittest.TestCase):
         self.assertRaises(ucltip.CommandNotFound, ucltip.Cmd, 1234.5)
         self.assertRaises(ucltip.CommandNotFound, ucltip.Cmd, '000')
 
+class PathResolverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.resolver = ucltip.PathResolver()
+        self.resolver.check_interval = 0
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.environ['PATH']
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmpdir)
+
+    def _mkcmd(self, name):
+        filename = os.path.join(self.tmpdir, name)
+        open(filename, 'w').close()
+        os.chmod(filename, 0o755)
+        return filename
+
+    def test_which(self):
+        sh = self.resolver.which('sh')
+        self.assertTrue(sh.endswith('/sh'))
+        self.assertEquals(sh, self.resolver.which('sh'))
+        # commands not found are searched again
+        self.assertEquals(None, self.resolver.which('ucltip-none'))
+        self.assertEquals(None, self.resolver.which('ucltip-none'))
+        self.assertEquals((1, 3), (self.resolver.hits, self.resolver.misses))
+        self.assertTrue(ucltip.which('sh').endswith('/sh'))
+
+    def test_installed_later(self):
+        """test a command installed after a failed lookup is found at once"""
+        self.resolver.check_interval = 60
+        os.environ['PATH'] = self.tmpdir
+        self.assertEquals(None, self.resolver.which('ucltip-new'))
+        self.assertEquals({'ucltip-new': None}, self.resolver.which_many(['ucltip-new']))
+        filename = self._mkcmd('ucltip-new')
+        self.assertEquals(filename, self.resolver.which('ucltip-new'))
+
+    def test_invalidate(self):
+        os.environ['PATH'] = self.tmpdir
+        self.assertEquals(None, self.resolver.which('ucltip-new'))
+        # directory mtime changes after a command is created
+        os.utime(self.tmpdir, (0, 0))
+        filename = self._mkcmd('ucltip-new')
+        self.assertEquals(filename, self.resolver.which('ucltip-new'))
+        # PATH changes
+        os.environ['PATH'] = self.path
+        self.assertEquals(None, self.resolver.which('ucltip-new'))
+        self.assertEquals(0, self.resolver.hits)
+
+    def test_which_many(self):
+        filename = self._mkcmd('ucltip-new')
+        os.mkdir(os.path.join(self.tmpdir, 'ucltip-dir'))
+        os.environ['PATH'] = os.pathsep.join([self.tmpdir, self.path])
+        self.assertEquals({'ucltip-new': filename, 'ucltip-dir': None, 'ucltip-none': None,
+                           'sh': ucltip.which('sh')},
+                          self.resolver.which_many(['ucltip-new', 'ucltip-dir', 'ucltip-none', 'sh']))
+        self.assertEquals(filename, self.resolver.which('ucltip-new'))
+        self.assertEquals(None, self.resolver.which('ucltip-none'))
+        self.assertEquals((1, 5), (self.resolver.hits, self.resolver.misses))
+
+def _running(pid):
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except IOError:
+        return False
+
 class ExecuteCmdTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -97,6 +202,198 @@ class ExecuteCmdTestCase(unittest.TestCase):
         self.assertEquals(self.expr('3', '+', '4'), '7\n')
         self.assertRaises(ucltip.CommandExecutedError, self.expr, '3', '5', '4')
         self.assertEquals(self.expr('3', '+', '4', via_shell=True), 0)
+        # every argument is one word, but shell variables are expanded
+        test = ucltip.Cmd('test')
+        self.assertEquals(0, test('a b', '=', 'a b', via_shell=True))
+        self.assertEquals(0, test('$HOME', '=', os.environ['HOME'], via_shell=True))
+        # os.system can not be timed out
+        self.assertRaises(AssertionError, test, 'a', via_shell=True, timeout=1)
+        with ucltip.config(via_shell=True):
+            self.assertRaises(AssertionError, test, 'a', timeout=1)
+        with ucltip.config(timeout=0.01):
+            self.assertEquals(0, self.expr('3', '+', '4', via_shell=True))
+
+    def test_large_stderr(self):
+        """test command writes more than a pipe buffer to stdout and stderr"""
+        sh = ucltip.Cmd('sh')
+        script = "head -c 1048576 /dev/zero | tr '\\0' x >&2; head -c 1048576 /dev/zero"
+        status, out = sh('-c', script, with_extend_output=True)
+        self.assertEquals(0, status)
+        self.assertEquals(1048576, len(out))
+        try:
+            sh('-c', script + '; exit 3')
+        except ucltip.CommandExecutedError as e:
+            self.assertEquals(3, e.status)
+            self.assertEquals(1048576, len(e.errmsg))
+        else:
+            self.fail('CommandExecutedError not raised')
+        self.assertEquals('exit status 1', str(ucltip.CommandExecutedError(1)))
+
+    def test_stderr_limit(self):
+        """test only the tail of large stderr is kept in memory"""
+        sh = ucltip.Cmd('sh')
+        script = 'seq 1000 >&2; exit 1'
+        for spill in (False, True):
+            with ucltip.config(stderr_limit=4, stderr_spill=spill):
+                try:
+                    sh('-c', script)
+                except ucltip.CommandExecutedError as e:
+                    self.assertEquals(['sh', '-c', script], e.argv)
+                    self.assertEquals('000\n', e.errmsg)
+                    self.assertTrue(e.truncated)
+                    if spill:
+                        self.assertEquals(ucltip.Cmd('seq')(1000), e.spill.read())
+                    else:
+                        self.assertEquals(None, e.spill)
+                else:
+                    self.fail('CommandExecutedError not raised')
+        with ucltip.config(stderr_limit=4, stderr_spill=True):
+            output = sh('-c', script, stream=True)
+            self.assertRaises(ucltip.CommandExecutedError, list, output)
+            self.assertEquals(1, sh('-c', script, with_extend_output=True)[0])
+
+    def test_stream(self):
+        """test streaming output lines or chunks"""
+        seq = ucltip.Cmd('seq')
+        self.assertEquals(['1\n', '2\n', '3\n'], list(seq(3, stream=True)))
+        self.assertEquals(['1\n2', '\n3\n'], list(seq(3, stream=3)))
+        sh = ucltip.Cmd('sh')
+        output = sh('-c', 'echo out; echo err >&2; exit 2', stream=True)
+        self.assertEquals('out\n', next(output))
+        try:
+            next(output)
+        except ucltip.CommandExecutedError as e:
+            self.assertEquals(2, e.status)
+            self.assertEquals('err\n', e.errmsg)
+        else:
+            self.fail('CommandExecutedError not raised')
+        # a long line is read by many chunks
+        script = "head -c 4194304 /dev/zero | tr '\\0' x; printf '\\n\\na'"
+        start = time.time()
+        self.assertEquals([4194305, 1, 1], [len(line) for line in sh('-c', script, stream=True)])
+        self.assertTrue(time.time() - start < 1)
+        # the process is started when output is read first
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        flag = os.path.join(tmpdir, 'started')
+        output = sh('-c', 'touch "$0"; head -c 1048576 /dev/zero', flag, stream=True)
+        del output
+        time.sleep(0.1)
+        self.assertFalse(os.path.exists(flag))
+        output = sh('-c', 'touch "$0"; head -c 1048576 /dev/zero', flag, stream=4096)
+        self.assertEquals(4096, len(next(output)))
+        self.assertTrue(os.path.exists(flag))
+        output.close()
+
+    def test_timeout(self):
+        """test killing command and its children when it is timed out"""
+        sh = ucltip.Cmd('sh')
+        started = time.time()
+        try:
+            sh('-c', 'echo partial; sleep 30 & echo $!; wait', timeout=0.3)
+        except ucltip.CommandTimeoutError as e:
+            self.assertTrue(isinstance(e, ucltip.CommandExecutedError))
+            self.assertEquals(0.3, e.timeout)
+            out, pid = e.stdout.split()
+            self.assertEquals('partial', out)
+        else:
+            self.fail('CommandTimeoutError not raised')
+        self.assertTrue(time.time() - started < 5)
+        # the background sleep is killed with its process group
+        if os.path.exists('/proc/self/stat'):
+            time.sleep(0.1)
+            self.assertFalse(_running(int(pid)))
+        output = sh('-c', 'echo a; sleep 30', stream=True, timeout=0.3)
+        self.assertEquals('a\n', next(output))
+        self.assertRaises(ucltip.CommandTimeoutError, next, output)
+        self.assertEquals('7\n', self.expr(3, '+', 4, timeout=5))
+        # no pipe is left to read when all output is redirected
+        started = time.time()
+        self.assertRaises(ucltip.CommandTimeoutError, ucltip.Cmd('sleep'), 5, timeout=0.3,
+                          stdout_to=os.devnull, stderr_to=os.devnull)
+        self.assertTrue(time.time() - started < 2)
+
+    def test_redirect(self):
+        """test writing output to files directly"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        out, err = os.path.join(tmpdir, 'out'), os.path.join(tmpdir, 'err')
+        sh = ucltip.Cmd('sh')
+        self.assertEquals('', sh('-c', 'echo out; echo err >&2', stdout_to=out, stderr_to=err))
+        self.assertEquals('out\n', open(out).read())
+        self.assertEquals('err\n', open(err).read())
+        with open(out, 'ab') as f:
+            f.write('head\n')
+            sh('-c', 'echo fileobj', stdout_to=f)
+            sh('-c', 'echo fd', stdout_to=f.fileno())
+        self.assertEquals('out\nhead\nfileobj\nfd\n', open(out).read())
+        try:
+            sh('-c', 'seq 1000 >&2; exit 1', stderr_to=err, stderr_tee=4)
+        except ucltip.CommandExecutedError as e:
+            self.assertEquals('000\n', e.errmsg)
+        else:
+            self.fail('CommandExecutedError not raised')
+        self.assertEquals(ucltip.Cmd('seq')(1000), open(err).read())
+
+    def test_input(self):
+        """test feeding stdin while output is read"""
+        cat = ucltip.Cmd('cat')
+        data = 'x' * 4194304
+        self.assertEquals(data, cat(input=data))
+        self.assertEquals('\xe4\xb8\xad', cat(input=u'\u4e2d'))
+        self.assertEquals('012', cat(input=(str(i) for i in range(3))))
+        self.assertEquals(['a\n', 'b\n'], list(cat(input=['a\n', 'b\n'], stream=True)))
+        # the command does not read all input
+        self.assertEquals('x', ucltip.Cmd('head')(c=1, input=data))
+        with tempfile.TemporaryFile() as f:
+            f.write('from file')
+            f.flush()
+            f.seek(0)
+            self.assertEquals('from file', cat(input=f))
+
+    def test_resources(self):
+        """test resource limits and priorities are applied to the command"""
+        sh = ucltip.Cmd('sh')
+        resources = ucltip.Resources(cpu=5, nofile=(64, 128), nice=3)
+        self.assertEquals('5\n64\n128\n3\n',
+                          sh('-c', 'ulimit -t; ulimit -Sn; ulimit -Hn; nice', resources=resources))
+        # resources of the call override the ones of the command
+        sh.conf.resources = ucltip.Resources(cpu=5, nice=2)
+        self.assertEquals('5\n2\n', sh('-c', 'ulimit -t; nice'))
+        self.assertEquals('5\n0\n', sh('-c', 'ulimit -t; nice', resources=ucltip.Resources(nice=0)))
+        self.assertEquals('idle\n', sh('-c', 'ionice', resources=ucltip.Resources(ionice='idle')))
+        self.assertRaises(ValueError, ucltip.Resources, ionice='fast')
+
+    def test_map(self):
+        """test executing command for many items"""
+        items = [(i, '+', 1) for i in range(20)] + [('a', '+', 1)]
+        results = self.expr.map(items, max_workers=4)
+        self.assertEquals(['{0}\n'.format(i + 1) for i in range(20)], results[:20])
+        self.assertTrue(isinstance(results[20], ucltip.CommandExecutedError))
+        echo = ucltip.Cmd('echo')
+        self.assertEquals(['a -x y\n', 'b -x y\n'], echo.map(['a', 'b'], x='y'))
+        self.assertEquals([(0, '-x y\n')], list(echo.map([{'x': 'y'}], ordered=False)))
+        self.assertRaises(ValueError, echo.map, ['a'], max_workers=0)
+        self.assertRaises(ValueError, echo.map, ['a'], max_workers=0, ordered=False)
+
+    def test_bind(self):
+        """test running a plan with values of placeholders"""
+        P = ucltip.Placeholder
+        plan = self.expr.bind(P('a'), '+', P('b'))
+        self.assertEquals(('a', 'b'), plan.names)
+        self.assertEquals('7\n', plan.run(3, 4))
+        self.assertEquals('3\n', plan.run(a=1, b=2))
+        self.assertEquals('6\n', plan(5, b=1))
+        self.assertEquals((0, '2\n'), plan(1, 1, with_extend_output=True))
+        self.assertRaises(TypeError, plan.run, 1)
+        self.assertRaises(TypeError, plan.run, 1, 2, 3)
+        self.assertRaises(TypeError, plan.run, 1, 2, c=3)
+        self.assertRaises(ucltip.CommandExecutedError, plan.run, 'a', 'b')
+        self.assertEquals("Plan object of 'expr {a} + {b}'", repr(plan))
+        # values of placeholders are not split
+        self.assertEquals('a b\n', ucltip.Cmd('echo').bind(P('x'))('a b'))
+        self.expr.conf.dry_run = True
+        self.assertEquals(['expr', 'x', '+', 'x'], self.expr.bind(P('a'), '+', P('a'))('x'))
 
     def test_pipe(self):
         """test command pipe line"""
@@ -116,6 +413,11 @@ class ExecuteCmdTestCase(unittest.TestCase):
         """test dry_run """
         self.expr.conf.dry_run = True
         self.assertEquals(['expr', '1', '+', '2'], self.expr(1, '+', 2))
+        # default options are overridden by options of the call
+        self.expr.opts(t=1, cwd='/')
+        self.assertEquals(['expr', '1', '-t', '1'], self.expr(1))
+        self.assertEquals(['expr', '1', '-t', '2'], self.expr(1, t=2))
+        self.assertEquals(['expr', '1'], self.expr(1, t=False))
 
     def test_repr(self):
         self.assertEquals("Cmd object bound 'expr'", "{0}".format(self.expr))
@@ -177,6 +479,18 @@ class CmdDispatcherTestCase(unittest.TestCase):
         """test setting subcmd_prefix of cmd dispatcher"""
         self.cmdd.subcmd_prefix = '--'
         self.assertEquals('ucltip-apt-get --install\n', self.cmdd.install())
+        self.assertEquals('ucltip-apt-get --install\n', self.cmdd.install())
+        self.assertEquals('install', self.cmdd.install.name)
+
+    def test_getsubcmd(self):
+        """test sub commands are created once and have no __dict__"""
+        install = self.cmdd.install
+        self.assertTrue(install is self.cmdd.install)
+        self.assertTrue(install is self.cmdd.getsubcmd('install'))
+        self.assertTrue(install.conf is self.cmdd.conf)
+        self.assertFalse(hasattr(install, '__dict__'))
+        self.assertFalse(hasattr(ucltip.Cmd('ls'), '__dict__'))
+        self.assertFalse(hasattr(install.conf, '__dict__'))
 
     def test_opt_style(self):
         """test setting option style of cmd dispatcher"""
@@ -185,6 +499,16 @@ class CmdDispatcherTestCase(unittest.TestCase):
         self.cmdd.conf.opt_style = 'java'
         self.assertEquals('ucltip-apt-get install -test=1\n', self.cmdd.install(test=1))
 
+    def test_bind(self):
+        """test plans of sub commands are bound with options"""
+        P = ucltip.Placeholder
+        plan = self.cmdd.install.bind(P('pkg'), t=P('dist'))
+        self.assertEquals('ucltip-apt-get install vim -t maverick\n', plan('vim', 'maverick'))
+        self.cmdd.conf.opt_style = 'gnu'
+        plan = self.cmdd.install.bind(P('pkg'), test=P('dist'))
+        self.assertEquals(('pkg', 'dist'), plan.names)
+        self.assertEquals('ucltip-apt-get install emacs --test=lucid\n', plan(dist='lucid', pkg='emacs'))
+
 class CustomClassTestCase(unittest.TestCase):
 
     def test_cmd(self):
@@ -241,6 +565,414 @@ class PipeTestCase(unittest.TestCase):
     def test_exception(self):
         self.assertRaises(ucltip.PipeError, self.pipe.wait)
 
+    def test_pipefail(self):
+        """test failure of any command fails the pipe"""
+        self.pipe.add(ucltip.Cmd('sh'), '-c', 'echo failed >&2; exit 2')
+        self.pipe.add('cat')
+        self.assertRaises(ucltip.PipeError, self.pipe.wait)
+        self.assertEquals([2, 0], self.pipe.statuses)
+        self.assertEquals(['failed\n', ''], self.pipe.stderr_values)
+
+    def test_sigpipe(self):
+        """test command is stopped by SIGPIPE when the next command exits"""
+        self.pipe.add('yes')
+        self.pipe.add('head', '-n1')
+        self.assertEquals(0, self.pipe.wait())
+        self.assertEquals('y\n', self.pipe.stdout.read())
+
+    def test_large_stderr(self):
+        """test stderr of every command is drained"""
+        script = "head -c 1048576 /dev/zero | tr '\\0' x >&2; echo 1"
+        self.pipe.add(ucltip.Cmd('sh'), '-c', script)
+        self.pipe.add(ucltip.Cmd('sh'), '-c', 'cat; ' + script)
+        self.assertEquals(0, self.pipe.wait())
+        self.assertEquals('1\n1\n', self.pipe.stdout.read())
+        self.assertEquals(1048576, len(self.pipe.stderr.read()))
+
+    def test_redirect(self):
+        """test commands in the pipe redirect their output"""
+        with tempfile.TemporaryFile() as f:
+            self.pipe.add(ucltip.Cmd('sh'), '-c', 'echo 1; echo err >&2', stderr_to=os.devnull)
+            self.pipe.add(ucltip.Cmd('cat'), stdout_to=f)
+            self.assertEquals(0, self.pipe.wait())
+            self.assertEquals('', self.pipe.stdout.read())
+            self.assertEquals(['', ''], self.pipe.stderr_values)
+            f.seek(0)
+            self.assertEquals('1\n', f.read())
+        # the next command reads nothing
+        pipe = ucltip.Pipe()
+        pipe.add(ucltip.Cmd('echo'), 1, stdout_to=os.devnull)
+        pipe.add('wc', '-c')
+        self.assertEquals(0, pipe.wait())
+        self.assertEquals('0', pipe.stdout.read().strip())
+
+class ResultCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sh = ucltip.Cmd('sh')
+        self.tmpfile = tempfile.NamedTemporaryFile()
+
+    def test_cache(self):
+        self.sh.result_cache = ucltip.ResultCache(watch_files=[self.tmpfile.name], env=['UCLTIP_TEST'])
+        pid = self.sh('-c', 'echo $$')
+        self.assertEquals(pid, self.sh('-c', 'echo $$'))
+        self.assertEquals((1, 1), (self.sh.result_cache.hits, self.sh.result_cache.misses))
+        # different execute arguments and environment
+        self.assertNotEquals(pid, self.sh('-c', 'echo $$', cwd='/'))
+        os.environ['UCLTIP_TEST'] = '1'
+        try:
+            self.assertNotEquals(pid, self.sh('-c', 'echo $$'))
+        finally:
+            del os.environ['UCLTIP_TEST']
+        # watched file is modified
+        os.utime(self.tmpfile.name, (0, 0))
+        self.assertNotEquals(pid, self.sh('-c', 'echo $$'))
+
+    def test_modified_while_running(self):
+        """test a result is invalid if a watched file is changed while the command runs"""
+        self.sh.result_cache = ucltip.ResultCache(watch_files=[self.tmpfile.name])
+        self.tmpfile.write(b'old\n')
+        self.tmpfile.flush()
+        script = 'cat "$0"; echo new > "$0"; touch -d @1000 "$0"'
+        self.assertEquals('old\n', self.sh('-c', script, self.tmpfile.name))
+        self.assertEquals('new\n', self.sh('-c', script, self.tmpfile.name))
+        self.assertEquals(0, self.sh.result_cache.hits)
+
+    def test_ttl(self):
+        self.sh.result_cache = ucltip.ResultCache(ttl=0)
+        self.assertNotEquals(self.sh('-c', 'echo $$'), self.sh('-c', 'echo $$'))
+
+    def test_subcmd(self):
+        cmdd = ucltip.CmdDispatcher('ucltip-apt-get')
+        cmdd.show.result_cache = ucltip.ResultCache()
+        cmdd.show('vim')
+        cmdd.show('vim')
+        cmdd.install('vim')
+        self.assertEquals((1, 1), (cmdd.show.result_cache.hits, cmdd.show.result_cache.misses))
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.records = []
+        ucltip.add_hook(self.records.append)
+
+    def tearDown(self):
+        ucltip.remove_hook(self.records.append)
+
+    def _concurrent_call(self, func, count=20):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func()))
+                   for i in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_share_result(self):
+        """test concurrent calls with the same arguments spawn one process"""
+        sh = ucltip.Cmd('sh')
+        sh.single_flight = True
+        results = self._concurrent_call(lambda: sh('-c', 'sleep 0.5; echo $$'))
+        self.assertEquals(1, len(self.records))
+        self.assertEquals(1, len(set(results)))
+
+    def test_share_error(self):
+        false = ucltip.Cmd('sh')
+        false.single_flight = True
+        def call():
+            try:
+                false('-c', 'sleep 0.5; exit 1')
+            except ucltip.CommandExecutedError as e:
+                return e
+        results = self._concurrent_call(call)
+        self.assertEquals(1, len(self.records))
+        self.assertTrue(all(isinstance(e, ucltip.CommandExecutedError) for e in results))
+
+    def test_timeout(self):
+        """test calls with different timeout are not shared"""
+        sh = ucltip.Cmd('sh')
+        sh.single_flight = True
+        leader = threading.Thread(target=sh, args=('-c', 'sleep 1'))
+        leader.start()
+        time.sleep(0.1)
+        start = time.time()
+        self.assertRaises(ucltip.CommandTimeoutError, sh, '-c', 'sleep 1', timeout=0.2)
+        self.assertTrue(time.time() - start < 0.8)
+        leader.join()
+        self.assertNotEquals(ucltip.execution_key(['ls'], resources=ucltip.Resources(nice=1)),
+                             ucltip.execution_key(['ls'], resources=ucltip.Resources(nice=2)))
+        self.assertEquals(ucltip.execution_key(['ls'], resources=ucltip.Resources(affinity=[0])),
+                          ucltip.execution_key(['ls'], resources=ucltip.Resources(affinity=[0])))
+
+class HookTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.records = []
+        self.collector = ucltip.StatsCollector()
+        ucltip.add_hook(self.records.append)
+        ucltip.add_hook(self.collector)
+
+    def tearDown(self):
+        ucltip.remove_hook(self.records.append)
+        ucltip.remove_hook(self.collector)
+
+    def test_stats(self):
+        ucltip.Cmd('sh')('-c', 'echo out; echo error >&2')
+        stats = self.records[0]
+        self.assertEquals('sh', stats.name)
+        self.assertEquals(0, stats.status)
+        self.assertEquals((4, 6), (stats.stdout_bytes, stats.stderr_bytes))
+        self.assertTrue(stats.wall_time >= stats.first_byte_time >= stats.spawn_time > 0)
+        self.assertTrue(stats.max_rss > 0)
+
+    def test_collector(self):
+        cmdd = ucltip.CmdDispatcher('ucltip-apt-get')
+        cmdd.install('vim')
+        list(cmdd.install('vim', stream=True))
+        self.assertRaises(ucltip.CommandExecutedError, ucltip.Cmd('false'))
+        summary = self.collector.summary()
+        self.assertEquals(2, summary['ucltip-apt-get install']['count'])
+        self.assertEquals(1, summary['false']['failures'])
+        self.assertEquals(2, sum(summary['ucltip-apt-get install']['histogram']))
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio requires Python 3.5')
+class AsyncCmdTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import asyncio
+        import ucltip.aio
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.run = self.loop.run_until_complete
+        self.expr = ucltip.aio.AsyncCmd('expr')
+        self.cmdd = ucltip.aio.AsyncCmdDispatcher('ucltip-apt-get')
+
+    def tearDown(self):
+        import asyncio
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_call(self):
+        self.assertEqual(b'7\n', self.run(self.expr(3, '+', 4)))
+        self.assertEqual((1, b'0\n'), self.run(self.expr(3, '-', 3, with_extend_output=True)))
+        try:
+            self.run(self.expr('3', '5', '4'))
+        except ucltip.CommandExecutedError as e:
+            self.assertTrue(str(e).startswith('expr: '))
+        else:
+            self.fail('CommandExecutedError not raised')
+        self.assertEqual(b'ucltip-apt-get install vim\n', self.run(self.cmdd.install('vim')))
+        self.assertRaises(AssertionError, self.run, self.expr(1, via_shell=True, timeout=1))
+
+    def test_dry_run(self):
+        self.expr.conf.dry_run = True
+        self.assertEqual(['expr', '1', '+', '2'], self.run(self.expr(1, '+', 2)))
+
+    def test_bind(self):
+        plan = self.expr.bind(ucltip.Placeholder('a'), '+', 4)
+        self.assertEqual(b'7\n', self.run(plan(3)))
+        self.expr.conf.dry_run = True
+        self.assertEqual(['expr', '1', '+', '4'], self.run(plan(1)))
+
+    def test_single_flight(self):
+        import asyncio
+        sh = ucltip.aio.AsyncCmd('sh')
+        sh.single_flight = True
+        calls = [sh('-c', 'sleep 0.2; echo $$') for i in range(10)]
+        results = self.run(asyncio.gather(*calls))
+        self.assertEqual(1, len(set(results)))
+
+    def test_timeout(self):
+        sh = ucltip.aio.AsyncCmd('sh')
+        try:
+            self.run(sh('-c', 'echo partial; sleep 30', timeout=0.3))
+        except ucltip.CommandTimeoutError as e:
+            self.assertEqual(b'partial\n', e.stdout)
+        else:
+            self.fail('CommandTimeoutError not raised')
+        started = time.time()
+        self.assertRaises(ucltip.CommandTimeoutError, self.run,
+                          ucltip.aio.AsyncCmd('sleep')(5, timeout=0.3, stdout_to=os.devnull,
+                                                       stderr_to=os.devnull))
+        self.assertTrue(time.time() - started < 2)
+
+    def test_cancel(self):
+        import asyncio
+        sh = ucltip.aio.AsyncCmd('sh')
+        with tempfile.NamedTemporaryFile() as f:
+            for timeout in (None, 10):
+                task = self.loop.create_task(sh('-c', 'echo $$ > "$0"; exec sleep 30', f.name,
+                                                timeout=timeout))
+                self.run(asyncio.sleep(0.3))
+                task.cancel()
+                self.assertRaises(asyncio.CancelledError, self.run, task)
+                f.seek(0)
+                self.assertFalse(_running(int(f.read())))
+
+    def test_config_scope(self):
+        import asyncio
+        # a task runs with configure of the context it is created in
+        with ucltip.config(execmode='list'):
+            listed = self.loop.create_task(self.expr(1, '+', 2))
+        with ucltip.config(execmode='string'):
+            joined = self.loop.create_task(self.expr(1, '+', 2))
+        self.assertEqual([['expr', '1', '+', '2'], 'expr 1 + 2'],
+                          self.run(asyncio.gather(listed, joined)))
+
+    def test_map(self):
+        items = [(i, '+', 1) for i in range(10)] + [('a', '+', 1)]
+        results = self.run(self.expr.map(items, max_workers=3))
+        self.assertEqual([str(i + 1).encode() + b'\n' for i in range(10)], results[:10])
+        self.assertTrue(isinstance(results[10], ucltip.CommandExecutedError))
+        results = self.run(self.expr.map([(1, '+', 1), (2, '+', 2)], ordered=False))
+        self.assertEqual([(0, b'2\n'), (1, b'4\n')], sorted(results))
+        self.assertRaises(ValueError, self.run, self.expr.map([(1, '+', 1)], max_workers=0))
+
+    def test_stats(self):
+        records = []
+        ucltip.add_hook(records.append)
+        try:
+            self.assertEqual(b'2\n', self.run(self.expr(1, '+', 1)))
+        finally:
+            ucltip.remove_hook(records.append)
+        self.assertEqual(1, len(records))
+        stats = records[0]
+        self.assertEqual((0, 2), (stats.status, stats.stdout_bytes))
+        self.assertTrue(stats.wall_time is not None and stats.spawn_time is not None)
+
+    def test_resources(self):
+        sh = ucltip.aio.AsyncCmd('sh')
+        resources = ucltip.Resources(nofile=64, nice=3)
+        self.assertEqual(b'64\n3\n', self.run(sh('-c', 'ulimit -n; nice', resources=resources)))
+
+    def test_input(self):
+        cat = ucltip.aio.AsyncCmd('cat')
+        self.assertEqual(b'x' * 1048576, self.run(cat(input=[b'x' * 524288] * 2)))
+
+    def test_redirect(self):
+        sh = ucltip.aio.AsyncCmd('sh')
+        with tempfile.TemporaryFile() as f:
+            self.assertEqual((1, b''), self.run(sh('-c', 'echo out; echo err >&2; exit 1',
+                                                    stdout_to=f, stderr_to=f,
+                                                    with_extend_output=True)))
+            f.seek(0)
+            self.assertEqual(b'out\nerr\n', f.read())
+
+class CoprocessTestCase(unittest.TestCase):
+
+    def setUp(self):
+        framing = ucltip.SentinelFraming('echo __END__', '__END__')
+        self.sh = ucltip.Coprocess('sh', framing=framing, health_request='echo ok',
+                                   health_response='ok\n')
+
+    def tearDown(self):
+        self.sh.close()
+
+    def test_request(self):
+        with ucltip.Coprocess('cat') as cat:
+            self.assertEquals('a', cat.request('a'))
+            self.assertEquals('b', cat.request('b'))
+        self.assertEquals('2\n', self.sh.request('expr 1 + 1'))
+        self.assertEquals('1\n2\n', self.sh.request('echo 1; echo 2'))
+        self.assertEquals('', self.sh.request('echo error >&2'))
+
+    def test_large_request(self):
+        """test a request is written while the response is read"""
+        with ucltip.Coprocess('cat') as cat:
+            data = 'x' * 300000
+            self.assertEquals(data, cat.request(data, timeout=5))
+            self.assertEquals('a', cat.request('a', timeout=5))
+        # a large response is read by many chunks
+        started = time.time()
+        output = self.sh.request("head -c 33554432 /dev/zero | tr '\\0' x", timeout=10)
+        self.assertEquals(33554432, len(output))
+        self.assertTrue(time.time() - started < 5)
+        self.assertEquals('2\n', self.sh.request('expr 1 + 1'))
+
+    def test_many_fds(self):
+        """test requests work when fd numbers are over the limit of select"""
+        import resource
+        limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if limits[1] != resource.RLIM_INFINITY and limits[1] < 1200:
+            self.skipTest('not enough fds')
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(limits[0], 1200), limits[1]))
+        fds = [os.open(os.devnull, os.O_RDONLY) for i in range(1100)]
+        try:
+            self.assertEquals('2\n', self.sh.request('expr 1 + 1', timeout=5))
+        finally:
+            for fd in fds:
+                os.close(fd)
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+
+    def test_restart(self):
+        """test process is restarted after it crashed or timed out"""
+        self.assertRaises(ucltip.CoprocessError, self.sh.request, 'exit 3')
+        self.assertEquals('2\n', self.sh.request('expr 1 + 1'))
+        self.assertRaises(ucltip.CoprocessTimeout, self.sh.request, 'sleep 5', timeout=0.1)
+        self.assertEquals('2\n', self.sh.request('expr 1 + 1'))
+        self.assertEquals(2, self.sh.restarts)
+
+    def test_check(self):
+        self.assertFalse(self.sh.check())
+        self.assertTrue(self.sh.check())
+        self.sh.proc.kill()
+        self.sh.proc.wait()
+        self.assertFalse(self.sh.check())
+        self.assertTrue(self.sh.alive())
+
+    def test_pool(self):
+        with ucltip.CoprocessPool('cat', size=3) as pool:
+            threads = [threading.Thread(target=pool.request, args=(str(i),)) for i in range(10)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEquals('x', pool.request('x'))
+            self.assertEquals(0, pool.check())
+
+class BatchShellTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sh = ucltip.BatchShell()
+
+    def tearDown(self):
+        self.sh.close()
+
+    def test_run(self):
+        self.assertEquals("a b it's\n", self.sh.run('echo', 'a b', "it's"))
+        self.assertEquals('2\n', self.sh.run(ucltip.Cmd('expr'), 1, '+', 1))
+        self.assertEquals('x', self.sh.run('printf', 'x'))
+        # stdin of the shell is not read by commands
+        self.assertEquals('', self.sh.run('cat'))
+        # every command runs in the same shell
+        pid = '{0}\n'.format(self.sh.coprocess.proc.pid)
+        self.assertEquals(pid, self.sh.run('sh', '-c', 'echo $PPID'))
+        self.assertEquals(pid, self.sh.run('sh', '-c', 'echo $PPID'))
+
+    def test_error(self):
+        script = 'echo out; echo err >&2; exit 3'
+        self.assertEquals((3, 'out\n'), self.sh.run('sh', '-c', script, with_extend_output=True))
+        try:
+            self.sh.run('sh', '-c', script)
+        except ucltip.CommandExecutedError as e:
+            self.assertEquals(3, e.status)
+            self.assertEquals('err\n', e.errmsg)
+            self.assertEquals(['sh', '-c', script], e.argv)
+        else:
+            self.fail('CommandExecutedError is not raised')
+        self.assertEquals('ok\n', self.sh.run('echo', 'ok'))
+        with ucltip.config(stderr_limit=None):
+            self.assertRaises(ucltip.CommandExecutedError, self.sh.run, 'sh', '-c', script)
+        with ucltip.config(stderr_limit=2):
+            try:
+                self.sh.run('sh', '-c', script)
+            except ucltip.CommandExecutedError as e:
+                self.assertEquals(('r\n', True), (e.errmsg, e.truncated))
+        # the shell is restarted if it exited
+        self.assertRaises(ucltip.CoprocessError, self.sh.run, 'exit')
+        self.assertEquals('ok\n', self.sh.run('echo', 'ok'))
+
 class HelperTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -269,6 +1001,52 @@ class HelperTestCase(unittest.TestCase):
     def test_regcmddispatcher(self):
         self._regcmds('apt-get')
         self.assertEquals(type(apt_get), ucltip.CmdDispatcher)
+        self._regcmds('apt-cache', 'sed')
+        self.assertEquals(type(sed), ucltip.Cmd)
+
+    def test_lazy(self):
+        self._regcmds('ls', 'apt-get', 'ucltip-none', lazy=True)
+        self.assertEquals(type(ls), ucltip.LazyCmd)
+        self.assertEquals("LazyCmd object of 'ls'", repr(ls))
+        self.assertEquals(ucltip.Cmd, type(ls.resolve()))
+        self.assertTrue(ls.resolve() is ls.resolve())
+        self.assertEquals('ls', ls.name)
+        ls.single_flight = True
+        self.assertTrue(ls.resolve().single_flight)
+        self.assertEquals(ucltip.CmdDispatcher, type(apt_get.resolve()))
+        self.assertRaises(ucltip.CommandNotFound, ucltip_none)
+
+class ImportTestCase(unittest.TestCase):
+
+    # seconds, generous for slow machines, import takes 5-10 ms usually
+    MAX_IMPORT_TIME = 0.5
+
+    def _python(self, code):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = 'import sys, time; sys.path.insert(0, {0!r}); {1}'.format(root, code)
+        return ucltip.Cmd(sys.executable)('-c', code)
+
+    def test_lazy_import(self):
+        """test modules only used by execution are not imported"""
+        code = ("loaded = set(sys.modules); "
+                "import ucltip; ucltip.global_config(execmode='list'); "
+                "ucltip.Cmd('ls')(a=True); ucltip.CmdDispatcher('ucltip-apt-get').install('vim'); "
+                "ucltip.global_config(execmode='string'); ucltip.Cmd('ls')('a b'); "
+                "print(' '.join(m for m in ('subprocess', 'syslog', 'tempfile', 'logging', 'threading', "
+                "'select', 'signal', 'queue', 'Queue', 'contextvars') "
+                "if sys.modules.get(m) and m not in loaded))")
+        self.assertEquals('\n', self._python(code))
+
+    def test_logger_level(self):
+        """test the level set by the application is kept when the logger is made"""
+        code = ("import logging, ucltip; logging.getLogger('ucltip').setLevel(logging.CRITICAL); "
+                "ucltip.global_config(syslog=False); ucltip.ERR('false'); "
+                "print(logging.getLogger('ucltip').level)")
+        self.assertEquals('50\n', self._python(code))
+
+    def test_import_time(self):
+        code = 'start = time.time(); import ucltip; print(time.time() - start)'
+        self.assertTrue(float(self._python(code)) < self.MAX_IMPORT_TIME)
 
 class GlobalConfigTestCase(unittest.TestCase):
 
@@ -283,20 +1061,106 @@ class GlobalConfigTestCase(unittest.TestCase):
         ucltip.global_config(execmode='list')
         self.assertEquals(['ls','-a','-l'], ucltip.Cmd('ls')(a=True, l=True))
 
+    def test_debug(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        ucltip.logger.addHandler(handler)
+        ucltip.global_config(syslog=False)
+        root_level = logging.getLogger().level
+        try:
+            ucltip.Cmd('ls')
+            # debug level of the root logger does not enable debug messages
+            logging.getLogger().setLevel(logging.DEBUG)
+            ucltip.Cmd('ls')
+            self.assertEquals([], records)
+            ucltip.global_config(debug=True)
+            ucltip.Cmd('ls')
+            self.assertEquals("Created a Cmd object bound 'ls'", records[0].getMessage())
+        finally:
+            ucltip.global_config(debug=False, syslog=True)
+            ucltip.logger.removeHandler(handler)
+            logging.getLogger().setLevel(root_level)
+
+    def test_spawn_fast(self):
+        ucltip.global_config(execmode='process', spawn='fast')
+        try:
+            self.assertEquals('7\n', ucltip.Cmd('expr')(3, '+', 4))
+        finally:
+            ucltip.global_config(spawn='default')
+
+    def test_resources(self):
+        """test resources are applied by wrapper commands in fast spawn"""
+        sh = ucltip.Cmd('sh')
+        script = 'ulimit -t; ulimit -n; nice; ionice'
+        resources = ucltip.Resources(cpu=5, nofile=64, nice=3, ionice=('best-effort', 7))
+        with ucltip.config(execmode='process', spawn='fast'):
+            self.assertEquals('5\n64\n3\nbest-effort: prio 7\n', sh('-c', script, resources=resources))
+            self.assertEquals(0, sh('-c', 'test `nice` = 3', via_shell=True, resources=resources))
+        with ucltip.config(execmode='process', resources=ucltip.Resources(cpu=9, nice=1)):
+            self.assertEquals('9\n3\n', sh('-c', 'ulimit -t; nice', resources=ucltip.Resources(nice=3)))
+        with ucltip.config(execmode='process'):
+            self.assertEquals('unlimited\n0\n', sh('-c', 'ulimit -t; nice'))
+
+    def test_timeout(self):
+        ucltip.global_config(execmode='process', timeout=0.2)
+        try:
+            self.assertRaises(ucltip.CommandTimeoutError, ucltip.Cmd('sleep'), 30)
+            self.assertEquals('7\n', ucltip.Cmd('expr')(3, '+', 4))
+        finally:
+            ucltip.global_config(timeout=None)
+
+    def test_config_scope(self):
+        ucltip.global_config(execmode='process')
+        ls = ucltip.Cmd('ls')
+        with ucltip.config(execmode='list'):
+            self.assertEquals(['ls', '-a'], ls(a=True))
+            with ucltip.config(execmode='string'):
+                self.assertEquals('ls -a', ls(a=True))
+            self.assertEquals('list', ucltip.global_config('execmode'))
+            # changes of global configure are seen by scopes
+            ucltip.global_config(spawn='fast')
+            self.assertEquals('fast', ucltip.global_config('spawn'))
+            ucltip.global_config(spawn='default')
+            # map workers run with configure of the caller
+            self.assertEquals([['ls', 'a'], ['ls', 'b']], ls.map(['a', 'b']))
+            # other threads are not affected
+            modes = []
+            t = threading.Thread(target=lambda: modes.append(ucltip.global_config('execmode')))
+            t.start()
+            t.join()
+            self.assertEquals(['process'], modes)
+        self.assertEquals('process', ucltip.global_config('execmode'))
+        with ucltip.config(dry_run=True):
+            self.assertEquals(['ls', '-a'], ls(a=True))
+            echo = ucltip.Cmd('echo')
+        # a command created in the scope does not keep its configure
+        self.assertEquals('a\n', echo('a'))
+
     def test_execmode_string(self):
         ucltip.global_config(execmode='string')
         self.assertEquals('apt-get install vim -t maverick',
                           ucltip.CmdDispatcher('apt-get').install('vim',t='maverick'))
+        self.assertEquals("echo 'a b' --opt 'it'\"'\"'s'",
+                          ucltip.Cmd('echo')('a b', opt="it's"))
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(UtilsTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(PathResolverTestCase, 'test'))
     suite.addTest(unittest.makeSuite(ExecuteCmdTestCase, 'test'))
     suite.addTest(unittest.makeSuite(SubCmdTestCase, 'test'))
     suite.addTest(unittest.makeSuite(CmdDispatcherTestCase, 'test'))
     suite.addTest(unittest.makeSuite(CustomClassTestCase, 'test'))
     suite.addTest(unittest.makeSuite(PipeTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ResultCacheTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SingleFlightTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(HookTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(AsyncCmdTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(CoprocessTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(BatchShellTestCase, 'test'))
     suite.addTest(unittest.makeSuite(HelperTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ImportTestCase, 'test'))
     suite.addTest(unittest.makeSuite(GlobalConfigTestCase, 'test'))
     return suite
 
@@ -26,30 +26,71 @@ The module contains the following public classes:
 
     - Cmd -- Object for mapping a command has no sub commands
     - CmdDispatcher -- Object for mapping a command has sub commands
+    - Pipe -- Object for handling command pipeline
+    - Coprocess -- Object for sending many requests to a persistent process
 """
 
 __all__ = ['global_config',
+           'config',
            'regcmds',
            'make_optargs',
+           'shell_quote',
+           'render_command',
            'cmdexists',
+           'which',
+           'add_hook',
+           'remove_hook',
+           'StatsCollector',
+           'ResultCache',
            'Cmd',
            'SubCmd',
            'CmdDispatcher',
+           'LazyCmd',
+           'Placeholder',
+           'Resources',
+           'Plan',
            'CommandNotFound',
            'CommandExecutedError',
+           'CommandTimeoutError',
            'RequireParentCmd',
-           'Pipe']
+           'Pipe',
+           'Coprocess',
+           'CoprocessPool',
+           'LineFraming',
+           'SentinelFraming',
+           'ShellFraming',
+           'BatchShell',
+           'CoprocessError',
+           'CoprocessTimeout']
 
 # global variabl, please use global_config function to access it
 # execmode:
 #       process - run as process
 #       list    - produce command arguments list
 #       string  - produce command string
+# spawn:
+#       default - spawn process by default settings of subprocess.Popen
+#       fast    - spawn process by posix_spawn or vfork if it is possible
+# timeout:
+#       seconds a command can run before it is killed, None means no limit
+# stderr_limit:
+#       bytes of stderr kept in memory for the error message, None means all
+# stderr_spill:
+#       write all of stderr to a temporary file once it exceeds stderr_limit
+# resources:
+#       Resources of all commands, which are overridden by the ones of
+#       commands and calls
 #
 __GLOBAL_CONFIGS__ = {'execmode':'process',
                       'via_shell': False,
                       'dry_run':False,
-                      'debug':False}
+                      'debug':False,
+                      'syslog':True,
+                      'spawn':'default',
+                      'timeout':None,
+                      'stderr_limit':1048576,
+                      'stderr_spill':False,
+                      'resources':None}
 
 # commands has sub command list
 # which is used in regcmds function
@@ -62,10 +103,54 @@ __CMDDISPATCHERS_LIST__ = (
         'bzr',
         'git')
 
-import subprocess
-import syslog
 import sys
 import os
+import time
+import errno
+import collections
+import itertools
+import io
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import thread as _thread
+except ImportError:
+    import _thread
+import contextlib
+
+class _LazyModule(object):
+    """Object for importing a module at the first time it is used, the
+       global name is bound to the module then
+    """
+
+    def __init__(self, module, name=None):
+        self._module = module
+        self._name = name or module
+
+    def __getattr__(self, attr):
+        module = __import__(self._module)
+        globals()[self._name] = module
+        return getattr(module, attr)
+
+# they are only needed when commands are executed or logs are written, which
+# saves import time of scripts using ucltip to make command arguments only
+subprocess = _LazyModule('subprocess')
+syslog = _LazyModule('syslog')
+tempfile = _LazyModule('tempfile')
+resource = _LazyModule('resource')
+logging = _LazyModule('logging')
+threading = _LazyModule('threading')
+select = _LazyModule('select')
+signal = _LazyModule('signal')
+copy = _LazyModule('copy')
+bisect = _LazyModule('bisect')
+binascii = _LazyModule('binascii')
+queue = _LazyModule(sys.version_info[0] < 3 and 'Queue' or 'queue', 'queue')
+
+# marker of missing values
+_MISSING = object()
 
 extra = {}
 if sys.platform == 'win32':
@@ -74,13 +159,87 @@ if sys.platform == 'win32':
 # =====================
 # Logging functions
 # =====================
+class _LazyLogger(object):
+    """Object for creating the logger at the first time it is used, the
+       global name logger is bound to the logger then
+    """
+
+    def __getattr__(self, attr):
+        return getattr(_make_logger(), attr)
+
+# 'ucltip' logger of logging module, and the handler writes its records to
+# syslog, they are made at the first time a message is logged
+logger = _LazyLogger()
+syslog_handler = None
+SyslogHandler = None
+# debug messages are logged only if debug is configured, whatever the level
+# of the root logger is
+_DEBUG = False
+
+def _make_logger():
+    global logger, syslog_handler, SyslogHandler
+    with _LOGGER_LOCK:
+        if not isinstance(logger, _LazyLogger):
+            return logger
+
+        class SyslogHandler(logging.Handler):
+            """Handler for writing log records to syslog
+            """
+
+            PRIORITIES = {logging.DEBUG: 'LOG_DEBUG',
+                          logging.INFO: 'LOG_INFO',
+                          logging.WARNING: 'LOG_WARNING',
+                          logging.ERROR: 'LOG_ERR',
+                          logging.CRITICAL: 'LOG_CRIT'}
+
+            def emit(self, record):
+                try:
+                    msg = self.format(record).replace('\0', '\\0')
+                    priority = getattr(syslog, self.PRIORITIES.get(record.levelno, 'LOG_ERR'))
+                    syslog.syslog(priority, msg)
+                except Exception:
+                    self.handleError(record)
+
+        syslog_handler = SyslogHandler()
+        syslog_handler.setFormatter(logging.Formatter('UCLTIP: %(message)s'))
+        _logger = logging.getLogger('ucltip')
+        # keep a level the application set before the first message
+        if _logger.level == logging.NOTSET:
+            _logger.setLevel(_DEBUG and logging.DEBUG or logging.INFO)
+        if __GLOBAL_CONFIGS__['syslog']:
+            _logger.addHandler(syslog_handler)
+        logger = _logger
+        return logger
+
+_LOGGER_LOCK = _thread.allocate_lock()
+
+# how many bytes of a error message are logged
+LOG_ERRMSG_SIZE = 4096
+
 def ERR(cmdstr, errmsg='None'):
-    syslog.syslog(syslog.LOG_ERR,
-           'UCLTIP: Executed "{}" failed, Err Msg:{}'.format(cmdstr, errmsg))
+    if errmsg and len(errmsg) > LOG_ERRMSG_SIZE:
+        errmsg = errmsg[-LOG_ERRMSG_SIZE:]
+    logger.error('Executed "%s" failed, Err Msg:%s', cmdstr, errmsg)
 
-def DBG(msg):
-    if global_config().get('debug'):
-        syslog.syslog(syslog.LOG_DEBUG, 'UCLTIP: {} '.format(msg))
+def DBG(msg, *args):
+    """log debug message, msg is formatted with args only if debug is enabled
+    """
+    if _DEBUG:
+        logger.debug(msg, *args)
+
+def _config_logging(debug=None, use_syslog=None):
+    global _DEBUG
+    if debug is not None:
+        _DEBUG = bool(debug)
+        _make_logger().setLevel(debug and logging.DEBUG or logging.INFO)
+    if isinstance(logger, _LazyLogger):
+        # applied when the logger is made
+        return
+    if use_syslog is not None:
+        if use_syslog:
+            logger.addHandler(syslog_handler)
+        else:
+            logger.removeHandler(syslog_handler)
 
 # =============================
 # Utility functions and classes
@@ -89,14 +248,23 @@ def regcmds(*args, **kwargs):
     """register bound object in current environment
 
     @param cls Cmd or CmdDispatcher
+    @param lazy register LazyCmd objects, which create the bound objects at
+                the first time they are used, so unused commands cost nothing
     """
-    import __builtin__
+    try:
+        import __builtin__
+    except ImportError:
+        import builtins as __builtin__
     cls = kwargs.get('cls') or Cmd
+    lazy = kwargs.get('lazy', False)
     assert cls in (Cmd, CmdDispatcher), 'cls should be Cmd or CmdDispatcher class'
+    if not lazy:
+        # every directory in PATH is listed once for all commands
+        path_resolver.which_many(args)
     for cmdname in args:
-        if cmdname in __CMDDISPATCHERS_LIST__:
-            cls = CmdDispatcher
-        __builtin__.__dict__[undashify(cmdname)] = cls(cmdname)
+        cmdcls = cmdname in __CMDDISPATCHERS_LIST__ and CmdDispatcher or cls
+        obj = lazy and LazyCmd(cmdname, cmdcls) or cmdcls(cmdname)
+        __builtin__.__dict__[undashify(cmdname)] = obj
 
 def double_dashify(string):
     """add double dashify prefix in a string
@@ -113,6 +281,177 @@ def undashify(string):
     """
     return string.replace('-', '_')
 
+class LRUCache(object):
+    """Object for caching at most maxsize items, the least recently used
+       items are dropped first
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = {}
+        self._used = {}
+        self._tick = itertools.count()
+        # caches are made at import time, which does not import threading
+        self._lock = _thread.allocate_lock()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            return default
+        self._used[key] = next(self._tick)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._used[key] = next(self._tick)
+        if len(self._data) > self.maxsize:
+            self._evict()
+
+    def _evict(self):
+        with self._lock:
+            # drop a tenth of items at once, so the sorting cost is shared
+            # by many insertions
+            excess = len(self._data) - self.maxsize + self.maxsize // 10
+            if excess <= 0:
+                return
+            used = sorted(list(self._used.items()), key=lambda item: item[1])
+            for key, tick in used[:excess]:
+                self._data.pop(key, None)
+                self._used.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._used.clear()
+
+class PathResolver(object):
+    """Object for finding the path of commands in PATH
+
+    results are cached by (PATH, command name), the cache is dropped when
+    PATH changes or a directory in PATH is modified. the mtimes of directories
+    are checked at most once every check_interval seconds. commands which
+    are not found are not cached, so a command installed later is found.
+    """
+
+    check_interval = 1.0
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.reset()
+
+    def reset(self):
+        """drop all cached results"""
+        self._cache = {}
+        self._path = None
+        self._mtimes = None
+        self._checked = 0
+
+    def which(self, cmdname):
+        """get path of a command
+
+        @param str cmdname command name
+        @return str path of command, None if command does not exist
+        """
+        path = self._refresh()
+        key = (path, str(cmdname))
+        try:
+            result = self._cache[key]
+            self.hits += 1
+            return result
+        except KeyError:
+            self.misses += 1
+        result = self._search(key[1])
+        if result is not None:
+            self._cache[key] = result
+        return result
+
+    def which_many(self, cmdnames):
+        """get paths of many commands, every directory in PATH is listed
+           once instead of checking every command in it
+
+        @param iterable cmdnames command names
+        @return dict {cmdname: path of command or None}
+        """
+        path = self._refresh()
+        result = {}
+        pending = set()
+        for cmdname in cmdnames:
+            key = (path, str(cmdname))
+            if key in self._cache:
+                self.hits += 1
+                result[key[1]] = self._cache[key]
+            elif os.sep in key[1]:
+                self.misses += 1
+                result[key[1]] = self._search(key[1])
+                if result[key[1]] is not None:
+                    self._cache[key] = result[key[1]]
+            else:
+                self.misses += 1
+                pending.add(key[1])
+        for element in self._dirs():
+            if not pending:
+                break
+            try:
+                entries = os.listdir(element)
+            except OSError:
+                continue
+            for cmdname in pending.intersection(entries):
+                filename = os.path.join(element, cmdname)
+                if os.path.isfile(filename) and os.access(filename, os.X_OK):
+                    result[cmdname] = self._cache[(path, cmdname)] = filename
+                    pending.discard(cmdname)
+        for cmdname in pending:
+            result[cmdname] = None
+        return result
+
+    def _refresh(self):
+        # drop cached results if PATH or directories in it are changed
+        path = os.environ.get('PATH', '')
+        if path != self._path or self._modified():
+            self._cache = {}
+            self._path = path
+            self._mtimes = self._dir_mtimes()
+        return path
+
+    def _dirs(self):
+        return [element for element in self._path.split(os.pathsep) if element]
+
+    def _dir_mtimes(self):
+        self._checked = time.time()
+        mtimes = []
+        for d in self._dirs():
+            try:
+                mtimes.append(os.stat(d).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def _modified(self):
+        if time.time() - self._checked < self.check_interval:
+            return False
+        return self._dir_mtimes() != self._mtimes
+
+    def _search(self, cmdname):
+        for element in self._dirs():
+            filename = os.path.join(element, cmdname)
+            if os.path.isfile(filename) and os.access(filename, os.X_OK):
+                return filename
+
+path_resolver = PathResolver()
+
+def which(cmdname):
+    """get path of a command
+
+    @param str cmdname command name
+    @return str path of command, None if command does not exist
+    """
+    return path_resolver.which(cmdname)
+
 def cmdexists(cmdname):
     """check if command exists
 
@@ -120,12 +459,7 @@ def cmdexists(cmdname):
     @return bool True if command exists otherwise False
     """
     assert 'PATH' in os.environ
-    executable = lambda filename: os.path.isfile(filename) and os.access(filename, os.X_OK)
-    filenames = [ os.path.join(element, str(cmdname)) \
-                  for element in os.environ['PATH'].split(os.pathsep) if element ]
-    for f in filenames:
-        if executable(f):
-            return True
+    return path_resolver.which(cmdname) is not None
 
 def global_config(query=None, **kwargs):
     """set or get global configure
@@ -137,9 +471,20 @@ def global_config(query=None, **kwargs):
                         list    - produce command arguments list
                         string  - produce command string
     @param dry_run: same as execmode=list
-    @param debug:   enable debug mode
+    @param debug:   enable debug mode, debug messages are logged by 'ucltip'
+                    logger of logging module
+    @param syslog:  write log messages to syslog, the default is True
+    @param spawn:   config how to spawn a process
 
-    @return dict __GLOBAL_CONFIGS__
+                     avliabl value:
+                        default - default settings of subprocess.Popen
+                        fast    - do not close inherited file descriptors, which
+                                  allows subprocess to use posix_spawn or vfork
+                                  instead of fork (Python 3.8 or later)
+
+    @param timeout: seconds a command can run before it is killed
+
+    @return dict __GLOBAL_CONFIGS__, or the value of query in current context
     @example:
 
         # get value
@@ -147,13 +492,121 @@ def global_config(query=None, **kwargs):
         # set value
         >>> global_config(dry_run=True)
     """
+    global _config_version
     if kwargs:
         __GLOBAL_CONFIGS__.update(kwargs)
+        _config_version += 1
+        if 'debug' in kwargs or 'syslog' in kwargs:
+            _config_logging(kwargs.get('debug'), kwargs.get('syslog'))
     elif query:
-        return __GLOBAL_CONFIGS__.get(query)
+        return current_config().get(query)
     else:
         return __GLOBAL_CONFIGS__
 
+# increased when global configure is changed, snapshots of config scopes are
+# rebuilt if it is changed
+_config_version = 0
+
+class _ConfigScope(object):
+    """Object for configure overridden in a context, it keeps a snapshot of
+       configure merged with outer scopes
+    """
+
+    __slots__ = ('parent', 'overrides', '_version', '_snapshot')
+
+    def __init__(self, parent, overrides):
+        self.parent = parent
+        self.overrides = overrides
+        self._version = None
+        self._snapshot = None
+
+    def snapshot(self):
+        if self._version != _config_version:
+            parent = self.parent
+            snapshot = dict(parent is not None and parent.snapshot() or __GLOBAL_CONFIGS__)
+            snapshot.update(self.overrides)
+            self._snapshot, self._version = snapshot, _config_version
+        return self._snapshot
+
+if sys.version_info >= (3, 7):
+    # the context variable is made at the first time a scope is set, so
+    # contextvars is not imported if config is not used
+    _SCOPE = None
+    _SCOPE_LOCK = _thread.allocate_lock()
+
+    def _get_scope():
+        return _SCOPE is not None and _SCOPE.get() or None
+
+    def _set_scope(scope):
+        global _SCOPE
+        if _SCOPE is None:
+            with _SCOPE_LOCK:
+                if _SCOPE is None:
+                    import contextvars
+                    _SCOPE = contextvars.ContextVar('ucltip_config', default=None)
+        return _SCOPE.set(scope)
+
+    def _reset_scope(token):
+        _SCOPE.reset(token)
+else:
+    # configure scopes are local to the thread
+    _LOCAL = _thread._local()
+
+    def _get_scope():
+        return getattr(_LOCAL, 'scope', None)
+
+    def _set_scope(scope):
+        token = _get_scope()
+        _LOCAL.scope = scope
+        return token
+
+    def _reset_scope(token):
+        _LOCAL.scope = token
+
+def current_config():
+    """get configure of current context, it should not be modified
+
+    @return dict
+    """
+    scope = _get_scope()
+    if scope is None:
+        return __GLOBAL_CONFIGS__
+    return scope.snapshot()
+
+@contextlib.contextmanager
+def config(**kwargs):
+    """override global configure in a with block, other threads and asyncio
+       tasks are not affected, debug and syslog can only be set by
+       global_config
+
+    @param kwargs the same as global_config
+    @example:
+
+        >>> with ucltip.config(execmode='list'):
+        ...     ucltip.Cmd('ls')(a=True)
+        ['ls', '-a']
+    """
+    assert not ('debug' in kwargs or 'syslog' in kwargs),\
+        "debug and syslog can only be set by global_config."
+    token = _set_scope(_ConfigScope(_get_scope(), kwargs))
+    try:
+        yield current_config()
+    finally:
+        _reset_scope(token)
+
+def _bind_config(func):
+    """make func run with configure of current context, for running it in
+       other threads
+    """
+    scope = _get_scope()
+    def wrapper(*args, **kwargs):
+        token = _set_scope(scope)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _reset_scope(token)
+    return wrapper
+
 # =====================
 # Options and Arguments
 # =====================
@@ -209,8 +662,7 @@ class OptionCreator(object):
         self._result = []
         for k, v in kwargs.items():
             self.__append_opt(k, v)
-        DBG('Trasform Kwargs:input:{}, result:{}'.format(kwargs,
-                                                         self._result))
+        DBG('Trasform Kwargs:input:%s, result:%s', kwargs, self._result)
         return self._result
 
     def __append_opt(self, k, v):
@@ -219,22 +671,44 @@ class OptionCreator(object):
         @param str k option name
         @param str v option value
         """
+        name, prefix = self._template(k)
         if type(v) is not bool:
-            v=str(v)
-            if self.opt_style in ('gnu', 'java'):
-                self._result.append('{0}={1}'.format(self.optname(k),v))
+            if prefix:
+                self._result.append(prefix + str(v))
             else:
-                self._result.append(self.optname(k))
-                self._result.append(v)
+                self._result.append(name)
+                self._result.append(str(v))
         elif v == True:
-            self._result.append(self.optname(k))
+            self._result.append(name)
+
+    def _template(self, k):
+        """get option name and prefix of key-value option
+
+        @param str k option name
+        @return tuple (option name, prefix), prefix is None if the option
+                value is a separated argument
+        """
+        key = (self.opt_style, k)
+        template = _OPTION_TEMPLATES.get(key)
+        if template is None:
+            name = self._optname(k)
+            template = (name, self.opt_style in ('gnu', 'java') and name + '=' or None)
+            _OPTION_TEMPLATES[key] = template
+        return template
 
     def optname(self, k):
         """get option name"""
+        return self._template(k)[0]
+
+    def _optname(self, k):
         return (len(k) == 1 or self.opt_style == 'java') and \
                '-{0}'.format(dashify(k)) or \
                '--{0}'.format(dashify(k))
 
+# (opt_style, option key) -> (option name, key-value prefix),
+# shared by all OptionCreator objects
+_OPTION_TEMPLATES = LRUCache(4096)
+
 def make_optargs(optname, values, opt_style='posix'):
     """create command line options, same key but different values
 
@@ -245,6 +719,47 @@ def make_optargs(optname, values, opt_style='posix'):
     """
     return OptionCreator(opt_style).make_optargs(optname, values)
 
+# characters need not be quoted in POSIX shell, the same as shlex.quote
+_SHELL_SAFE = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                        '0123456789@%_-+=:,./')
+
+def shell_quote(arg, expand=False):
+    """quote an argument as one word of POSIX shell, the same as
+       shlex.quote, but parameter expansion like $HOME and command
+       substitution still work if expand is True
+
+    @param str arg
+    @param bool expand quote by double quotes instead of single quotes
+    @return str quoted argument
+    """
+    if not arg:
+        return expand and '""' or "''"
+    if _SHELL_SAFE.issuperset(arg):
+        return arg
+    if expand:
+        for c in '\\"`':
+            arg = arg.replace(c, '\\' + c)
+        return '"' + arg + '"'
+    return "'" + arg.replace("'", "'\"'\"'") + "'"
+
+# (expand, command arguments) -> command string
+_RENDERED = LRUCache(4096)
+
+def render_command(argv, expand=False):
+    """render command arguments as a shell command string, every argument
+       is one word, commands run repeatedly are rendered once
+
+    @param list argv command arguments
+    @param bool expand keep parameter expansion, see shell_quote
+    @return str command string
+    """
+    key = (expand, tuple(argv))
+    command = _RENDERED.get(key)
+    if command is None:
+        command = ' '.join([shell_quote(arg, expand) for arg in argv])
+        _RENDERED[key] = command
+    return command
+
 # =====================
 # Exceptions Clasees
 # =====================
@@ -257,14 +772,40 @@ class CommandNotFound(Exception):
         return self.errmsg
 
 class CommandExecutedError(Exception):
+    """raised when a command exits with non-zero status, errmsg is its stderr,
+       which only has the tail of stderr if truncated is True, all of stderr
+       is in the file object spill if stderr_spill is configured
+    """
 
-    def __init__(self, status, errmsg=None):
+    def __init__(self, status, errmsg=None, argv=None, spill=None, truncated=False):
         self.status = status
         self.errmsg = errmsg
+        self.argv = argv
+        self.spill = spill
+        self.truncated = truncated
 
     def __str__(self):
+        if not self.errmsg:
+            return 'exit status %s' % self.status
+        if bytes is not str and isinstance(self.errmsg, bytes):
+            return self.errmsg.decode('utf-8', 'replace')
         return self.errmsg
 
+class CommandTimeoutError(CommandExecutedError):
+    """raised when a command does not terminate in time, the command and
+       the processes it created are killed, output written before that is
+       kept in stdout and errmsg
+    """
+
+    def __init__(self, timeout, status, errmsg=None, stdout=None, argv=None,
+                 spill=None, truncated=False):
+        CommandExecutedError.__init__(self, status, errmsg, argv, spill, truncated)
+        self.timeout = timeout
+        self.stdout = stdout
+
+    def __str__(self):
+        return 'Command timed out after %s seconds' % self.timeout
+
 class RequireParentCmd(Exception):
     pass
 
@@ -275,23 +816,915 @@ class NotValideOptStyle(Exception):
     def __str__(self):
         return self.opt_style
 
+# =========
+# I/O Engine
+# =========
+# size of every read from a pipe
+CHUNK_SIZE = 65536
+# how many bytes of stderr are kept when the output is streamed
+STDERR_TAIL_SIZE = 65536
+# seconds between SIGTERM and SIGKILL when a command is timed out
+KILL_GRACE = 1.0
+
+class PipeTimeout(Exception):
+    """raised by iter_pipes when the deadline is passed"""
+
+class ChunkBuffer(object):
+    """Object for collecting data read from a pipe
+
+    chunks are kept in a list and joined only once when the value is
+    requested, so the cost of growing the buffer is linear.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self.size += len(data)
+
+    def getvalue(self):
+        if len(self._chunks) > 1:
+            self._chunks = [b''.join(self._chunks)]
+        return self._chunks and self._chunks[0] or b''
+
+class TailBuffer(object):
+    """Object for keeping only the last limit bytes written to it
+    """
+
+    # temporary file has all data written, see SpillBuffer
+    spill = None
+
+    def __init__(self, limit=STDERR_TAIL_SIZE):
+        self.limit = limit
+        self._chunks = collections.deque()
+        self._kept = 0
+        # total size of data has been written
+        self.size = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._kept += len(data)
+        self.size += len(data)
+        while self._kept - len(self._chunks[0]) >= self.limit:
+            self._kept -= len(self._chunks.popleft())
+
+    @property
+    def truncated(self):
+        return self.size > self.limit
+
+    def getvalue(self):
+        return b''.join(self._chunks)[-self.limit:]
+
+    def close(self):
+        pass
+
+class SpillBuffer(TailBuffer):
+    """Object for keeping only the last limit bytes written to it in memory,
+       all data is written to a temporary file once it exceeds limit
+    """
+
+    def write(self, data):
+        if self.spill is None and self.size + len(data) > self.limit:
+            # all data written before is still kept
+            self.spill = tempfile.TemporaryFile()
+            self.spill.write(TailBuffer.getvalue(self))
+        if self.spill is not None:
+            self.spill.write(data)
+        TailBuffer.write(self, data)
+
+def stderr_capture(limit, spill=False):
+    """get a buffer for stderr of a process
+
+    @param int limit bytes kept in memory, None means all of stderr is kept
+    @param bool spill write all of stderr to a temporary file once it exceeds limit
+    @return TailBuffer, or None if limit is None
+    """
+    if limit is None:
+        return None
+    return spill and SpillBuffer(limit) or TailBuffer(limit)
+
+class TeeBuffer(TailBuffer):
+    """Object for writing data to a file and keeping only the last limit
+       bytes of it in memory
+    """
+
+    def __init__(self, target, limit=STDERR_TAIL_SIZE, owned=False):
+        """
+        @param file/int target file object or file descriptor
+        @param int limit
+        @param bool owned close target when the buffer is closed
+        """
+        TailBuffer.__init__(self, limit)
+        self.target = target
+        self.owned = owned
+        if isinstance(target, int):
+            self._fd = target
+        else:
+            self._fd = target.fileno()
+
+    def write(self, data):
+        TailBuffer.write(self, data)
+        while data:
+            data = data[os.write(self._fd, data):]
+
+    def close(self):
+        if self.owned:
+            self.target.close()
+
+class InputFeeder(object):
+    """Object for writing input of a process to a pipe piece by piece, so
+       reading output of the process is not blocked by it
+    """
+
+    def __init__(self, data):
+        """
+        @param bytes/str/iterable data input data, or a iterable of chunks,
+                                       str is encoded in UTF-8
+        """
+        if isinstance(data, (bytes, type(u''))):
+            data = [data]
+        self._chunks = self.chunks(data)
+        self._view = None
+
+    def __iter__(self):
+        return self._chunks
+
+    def chunks(self, data):
+        """@return generator yields chunks of data as bytes"""
+        for chunk in data:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf-8')
+            yield chunk
+
+    def feed(self, fd):
+        """write data to fd until all data is written or fd is full, a chunk
+           is not copied when it is written partially
+
+        @param int fd non-blocking file descriptor
+        @return bool True if all data is written or the reader is gone
+        """
+        while True:
+            if not self._view:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    return True
+                self._view = memoryview(chunk)
+            try:
+                written = os.write(fd, self._view)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    return False
+                if e.errno == errno.EPIPE:
+                    return True
+                raise
+            self._view = self._view[written:]
+
+def redirect_target(target):
+    """get a file can be given to subprocess.Popen as stdout or stderr
+
+    @param str/file/int target path, file object or file descriptor, a path
+                               is truncated, None means a pipe
+    @return tuple (file, file opened here which should be closed or None)
+    """
+    if target is None:
+        return subprocess.PIPE, None
+    if isinstance(target, int):
+        return target, None
+    if hasattr(target, 'fileno'):
+        # data buffered in python should be written before output of child
+        if hasattr(target, 'flush'):
+            target.flush()
+        return target, None
+    target = open(target, 'wb')
+    return target, target
+
+def _restore_signals():
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+def _new_process_group():
+    _restore_signals()
+    os.setpgrp()
+
+def _signal_group(proc, sig):
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(proc.pid, sig)
+        elif proc.returncode is None:
+            proc.terminate()
+    except OSError as e:
+        # the group is gone already
+        if e.errno not in (errno.ESRCH, errno.EPERM):
+            raise
+
+def terminate_process(proc, grace=KILL_GRACE):
+    """terminate a process started in its own process group and the
+       processes it created, SIGTERM is sent to the group first, and SIGKILL
+       after grace seconds
+
+    @param subprocess.Popen proc
+    @param float grace
+    """
+    _signal_group(proc, signal.SIGTERM)
+    deadline = time.time() + grace
+    while proc.poll() is None and time.time() < deadline:
+        time.sleep(0.01)
+    # children may ignore SIGTERM even if the leader has exited
+    _signal_group(proc, getattr(signal, 'SIGKILL', signal.SIGTERM))
+
+def iter_pipes(pipes, chunk_size=CHUNK_SIZE, deadline=None, feed=None):
+    """read many pipes at the same time until all of them reach EOF
+
+    @param list pipes file objects opened for reading
+    @param int chunk_size maximum size of every read
+    @param float deadline raise PipeTimeout if pipes do not reach EOF before
+                          this time.time() value, None means no deadline
+    @param tuple feed (pipe, InputFeeder), the pipe is written at the same
+                      time, and closed when all data is written
+    @return generator yields (pipe, data) as soon as data is available
+    """
+    if hasattr(select, 'poll'):
+        return _poll_pipes(pipes, chunk_size, deadline, feed)
+    return _thread_pipes(pipes, chunk_size, deadline, feed)
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    remain = deadline - time.time()
+    if remain <= 0:
+        raise PipeTimeout()
+    return remain
+
+def _poll_pipes(pipes, chunk_size, deadline=None, feed=None):
+    poller = select.poll()
+    fds = {}
+    for pipe in pipes:
+        fds[pipe.fileno()] = pipe
+        poller.register(pipe.fileno(), select.POLLIN | select.POLLPRI)
+    infd = None
+    if feed is not None:
+        inpipe, feeder = feed
+        infd = inpipe.fileno()
+        fcntl.fcntl(infd, fcntl.F_SETFL, fcntl.fcntl(infd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        poller.register(infd, select.POLLOUT)
+    while fds or infd is not None:
+        remain = _remaining(deadline)
+        try:
+            ready = poller.poll(remain is not None and remain * 1000 or None)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd, event in ready:
+            if fd == infd:
+                # POLLERR without POLLOUT means the reader is gone
+                if not event & select.POLLOUT or feeder.feed(fd):
+                    poller.unregister(fd)
+                    inpipe.close()
+                    infd = None
+                continue
+            data = os.read(fd, chunk_size)
+            if data:
+                yield fds[fd], data
+            else:
+                poller.unregister(fd)
+                del fds[fd]
+
+def _thread_pipes(pipes, chunk_size, deadline=None, feed=None):
+    # platforms without poll(), every pipe is read or written by its own thread
+    results = queue.Queue()
+    def writer(pipe, feeder):
+        try:
+            # the pipe is blocking, so all data is written
+            feeder.feed(pipe.fileno())
+        finally:
+            pipe.close()
+    if feed is not None:
+        t = threading.Thread(target=writer, args=feed)
+        t.daemon = True
+        t.start()
+    def reader(pipe):
+        try:
+            for data in iter(lambda: pipe.read(chunk_size), b''):
+                results.put((pipe, data))
+        finally:
+            results.put((pipe, None))
+    for pipe in pipes:
+        t = threading.Thread(target=reader, args=(pipe,))
+        t.daemon = True
+        t.start()
+    remain = len(pipes)
+    while remain:
+        try:
+            pipe, data = results.get(True, _remaining(deadline))
+        except queue.Empty:
+            raise PipeTimeout()
+        if data is None:
+            remain -= 1
+        else:
+            yield pipe, data
+
+def communicate(proc, stats=None, timeout=None, stderr_buffer=None, feeder=None):
+    """read stdout and stderr of a process at the same time and wait
+       for it to terminate, stdout or stderr which is not a pipe is skipped
+
+    @param subprocess.Popen proc
+    @param ExecutionStats stats record resource usage in it if it is not None
+    @param float timeout kill the process group of proc if it does not
+                         terminate in timeout seconds
+    @param TailBuffer stderr_buffer buffer for stderr, all of stderr is kept
+                                    if it is None
+    @param InputFeeder feeder write its data to stdin of the process
+    @return tuple (status, stdout_value, stderr_value)
+    @raise CommandTimeoutError
+    """
+    bufs = {}
+    if proc.stdout is not None:
+        bufs[proc.stdout] = ChunkBuffer()
+    if proc.stderr is not None:
+        bufs[proc.stderr] = stderr_buffer is not None and stderr_buffer or ChunkBuffer()
+    def value(pipe):
+        return pipe in bufs and bufs[pipe].getvalue() or b''
+    deadline = timeout is not None and time.time() + timeout or None
+    timed_out = False
+    feed = feeder is not None and (proc.stdin, feeder) or None
+    try:
+        try:
+            for pipe, data in iter_pipes(list(bufs), deadline=deadline, feed=feed):
+                bufs[pipe].write(data)
+                if stats is not None and pipe is proc.stdout:
+                    stats.got_output()
+            # nothing is left to read when output is redirected
+            status = wait_process(proc, stats, deadline)
+        except PipeTimeout:
+            timed_out = True
+            terminate_process(proc)
+            # keep output written before the process was killed, processes
+            # left the group may still hold the pipes
+            try:
+                for pipe, data in iter_pipes(list(bufs),
+                                             deadline=time.time() + KILL_GRACE):
+                    bufs[pipe].write(data)
+            except PipeTimeout:
+                pass
+            status = wait_process(proc, stats)
+    finally:
+        for pipe in bufs:
+            pipe.close()
+        if feed is not None:
+            proc.stdin.close()
+    if stats is not None:
+        stats.stdout_bytes = proc.stdout in bufs and bufs[proc.stdout].size or 0
+        stats.stderr_bytes = proc.stderr in bufs and bufs[proc.stderr].size or 0
+    if timed_out:
+        errbuf = bufs.get(proc.stderr)
+        raise CommandTimeoutError(timeout, status, value(proc.stderr),
+                                  value(proc.stdout),
+                                  spill=getattr(errbuf, 'spill', None),
+                                  truncated=getattr(errbuf, 'truncated', False))
+    return status, value(proc.stdout), value(proc.stderr)
+
+def wait_process(proc, stats=None, deadline=None):
+    """wait for a process to terminate
+
+    @param subprocess.Popen proc
+    @param ExecutionStats stats record resource usage of the process in it
+                                if it is not None
+    @param float deadline raise PipeTimeout if the process does not terminate
+                          before this time.time() value, None means no deadline
+    @return int returncode
+    """
+    if stats is None or not hasattr(os, 'wait4') or proc.returncode is not None:
+        if deadline is not None:
+            _wait_deadline(proc, deadline)
+        return proc.wait()
+    flags = deadline is not None and os.WNOHANG or 0
+    delay = 0.0005
+    while True:
+        try:
+            pid, sts, rusage = os.wait4(proc.pid, flags)
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+            continue
+        if pid:
+            break
+        time.sleep(min(delay, _remaining(deadline)))
+        delay = min(delay * 2, 0.05)
+    if os.WIFSIGNALED(sts):
+        proc.returncode = -os.WTERMSIG(sts)
+    else:
+        proc.returncode = os.WEXITSTATUS(sts)
+    stats.user_time = rusage.ru_utime
+    stats.sys_time = rusage.ru_stime
+    stats.max_rss = rusage.ru_maxrss
+    return proc.returncode
+
+def _wait_deadline(proc, deadline):
+    if sys.version_info[0] >= 3:
+        try:
+            proc.wait(_remaining(deadline))
+        except subprocess.TimeoutExpired:
+            raise PipeTimeout()
+        return
+    delay = 0.0005
+    while proc.poll() is None:
+        time.sleep(min(delay, _remaining(deadline)))
+        delay = min(delay * 2, 0.05)
+
+# ===============
+# Instrumentation
+# ===============
+# callbacks called with ExecutionStats after a command is executed
+_HOOKS = []
+
+def add_hook(func):
+    """register a callback, which is called with a ExecutionStats after
+       a command is executed
+
+    @param callable func
+    """
+    if func not in _HOOKS:
+        _HOOKS.append(func)
+
+def remove_hook(func):
+    """unregister a callback
+
+    @param callable func
+    """
+    if func in _HOOKS:
+        _HOOKS.remove(func)
+
+def run_hooks(stats):
+    for func in list(_HOOKS):
+        try:
+            func(stats)
+        except Exception:
+            logger.exception('Hook %r failed', func)
+
+class ExecutionStats(object):
+    """Object for recording timing and resource usage of a executed command
+
+    times are in seconds, max_rss is in the unit of getrusage (KB on Linux),
+    resource usage is None if it is not available.
+    """
+
+    def __init__(self, name, command):
+        self.name = name
+        self.command = command
+        self.started = time.time()
+        self.wall_time = None
+        self.spawn_time = None
+        self.first_byte_time = None
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+        self.status = None
+        self.user_time = None
+        self.sys_time = None
+        self.max_rss = None
+
+    def spawned(self):
+        self.spawn_time = time.time() - self.started
+
+    def got_output(self):
+        if self.first_byte_time is None:
+            self.first_byte_time = time.time() - self.started
+
+    def finish(self, status):
+        self.status = status
+        self.wall_time = time.time() - self.started
+        run_hooks(self)
+
+    def __repr__(self):
+        return "{0} of '{1}' status:{2} wall_time:{3}".format(self.__class__.__name__,
+                                                             self.name, self.status,
+                                                             self.wall_time)
+
+class StatsCollector(object):
+    """Hook for aggregating statistics and histogram of wall time per
+       command name
+
+    @example
+        collector = ucltip.StatsCollector()
+        ucltip.add_hook(collector)
+        ucltip.Cmd('ls')()
+        collector.summary('ls')['count']
+    """
+
+    """Upper bounds of histogram buckets in seconds"""
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self._lock = threading.Lock()
+        self._summary = {}
+
+    def __call__(self, stats):
+        with self._lock:
+            summary = self._summary.get(stats.name)
+            if summary is None:
+                summary = self._summary[stats.name] = {
+                        'count': 0, 'failures': 0,
+                        'wall_time': 0.0, 'user_time': 0.0, 'sys_time': 0.0,
+                        'stdout_bytes': 0, 'stderr_bytes': 0, 'max_rss': 0,
+                        'histogram': [0] * (len(self.buckets) + 1)}
+            summary['count'] += 1
+            summary['failures'] += stats.status != 0 and 1 or 0
+            summary['wall_time'] += stats.wall_time
+            summary['user_time'] += stats.user_time or 0.0
+            summary['sys_time'] += stats.sys_time or 0.0
+            summary['stdout_bytes'] += stats.stdout_bytes
+            summary['stderr_bytes'] += stats.stderr_bytes
+            summary['max_rss'] = max(summary['max_rss'], stats.max_rss or 0)
+            summary['histogram'][bisect.bisect_left(self.buckets, stats.wall_time)] += 1
+
+    def summary(self, name=None):
+        """get statistics
+
+        @param str name command name
+        @return dict statistics of the command, or statistics of all commands
+                by name if name is None
+        """
+        with self._lock:
+            if name is not None:
+                return copy.deepcopy(self._summary.get(name))
+            return copy.deepcopy(self._summary)
+
+    def reset(self):
+        with self._lock:
+            self._summary = {}
+
+# ==========================
+# Result Cache, Single Flight
+# ==========================
+def shareable(stdin=None, as_process=False, via_shell=False, stream=False,
+              stdout_to=None, stderr_to=None, input=None, **kwargs):
+    """check if the result of a execution can be shared by other executions
+       with the same arguments
+
+    @param kwargs execute arguments
+    @return bool
+    """
+    return not (stdin or as_process or via_shell or stream
+                or stdout_to is not None or stderr_to is not None
+                or input is not None
+                or current_config()['via_shell'])
+
+def execution_key(command, cwd=None, with_extend_output=False, timeout=None,
+                  resources=None, **kwargs):
+    """make key of a execution, executions with the same key have the same
+       result
+
+    @param list command
+    @param kwargs execute arguments
+    @return tuple key
+    """
+    return (tuple(command), cwd, bool(with_extend_output), timeout,
+            resources is not None and resources.key() or None)
+
+class SingleFlight(object):
+    """Object for making concurrent calls with the same key wait for one
+       in-flight call, and share its result or exception
+    """
+
+    def __init__(self):
+        self._lock = _thread.allocate_lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """call func, or wait for the in-flight call with the same key
+
+        @param key hashable key
+        @param callable func
+        @return result of func
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _FlightCall()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+class _FlightCall(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+# shared by all commands, the key includes command arguments
+single_flight = SingleFlight()
+
+class ResultCache(object):
+    """Object for caching results of read-only commands, a cached result is
+       returned without executing the command again.
+
+    the key of a result is command arguments, current directory, and values
+    of environment variables in env.
+
+    Keyword Arguments:
+        - ttl -- seconds a result is valid for, None means forever
+        - maxsize -- maximum number of results, the least recently used one
+          is dropped first
+        - watch_files -- results are invalid if mtime of any of these files
+          is changed, ie. /var/lib/dpkg/status or .git/HEAD
+        - env -- names of environment variables included in the key
+
+    @example
+        dpkg = ucltip.Cmd('dpkg')
+        dpkg.result_cache = ucltip.ResultCache(ttl=10, watch_files=['/var/lib/dpkg/status'])
+    """
+
+    def __init__(self, ttl=None, maxsize=128, watch_files=(), env=()):
+        self.ttl = ttl
+        self.watch_files = tuple(watch_files)
+        self.env = tuple(env)
+        self.hits = 0
+        self.misses = 0
+        self._results = LRUCache(maxsize)
+
+    def cacheable(self, **kwargs):
+        """check if the result of a execution can be cached
+
+        @param kwargs execute arguments
+        @return bool
+        """
+        return shareable(**kwargs)
+
+    def make_key(self, command, **kwargs):
+        """make cache key of a execution
+
+        @param list command
+        @param kwargs execute arguments
+        @return tuple key
+        """
+        return execution_key(command, **kwargs) + \
+                (tuple(os.environ.get(name) for name in self.env),)
+
+    def get(self, key, default=None):
+        """get a valid cached result
+
+        @return cached result, default if there is no valid result
+        """
+        entry = self._results.get(key)
+        if entry is not None:
+            result, expires, mtimes = entry
+            if (expires is None or time.time() < expires) and \
+               mtimes == self._mtimes():
+                self.hits += 1
+                return result
+        self.misses += 1
+        return default
+
+    def stamp(self):
+        """get expiry time and mtimes of watched files, which are taken
+           before the command is executed, so a file changed while it runs
+           invalidates the result
+
+        @return tuple (expires, mtimes)
+        """
+        return self.ttl is not None and time.time() + self.ttl or None, self._mtimes()
+
+    def set(self, key, result, stamp=None):
+        """cache a result
+
+        @param tuple stamp returned by stamp() before the execution, now if
+                           it is None
+        """
+        expires, mtimes = stamp or self.stamp()
+        self._results[key] = (result, expires, mtimes)
+
+    def clear(self):
+        """drop all cached results"""
+        self._results.clear()
+
+    def _mtimes(self):
+        mtimes = []
+        for filename in self.watch_files:
+            try:
+                mtimes.append(os.stat(filename).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+# =================
+# Resource Controls
+# =================
+class Resources(object):
+    """Object for resource limits and priorities of commands, which are
+       applied in the child process before the command is executed
+
+    with the fast spawn strategy or via_shell, they are applied by wrapper
+    commands prlimit, nice, ionice and taskset instead, so subprocess can
+    still spawn by posix_spawn or vfork. ionice always uses the wrapper
+    command, and so does affinity before python 3.3.
+
+    Keyword Arguments:
+        - cpu -- CPU time limit in seconds
+        - address_space -- address space limit in bytes
+        - nofile -- limit of open files, every limit is a number for both
+          soft and hard limits, or a tuple (soft, hard)
+        - nice -- A number added to the nice value
+        - ionice -- IO scheduling class `realtime`, `best-effort` or `idle`,
+          or a tuple (class, priority level)
+        - affinity -- A list of CPU numbers which the command runs on
+    """
+
+    # (attribute, resource name of resource module, option of prlimit)
+    RLIMITS = (('cpu', 'RLIMIT_CPU', '--cpu'),
+               ('address_space', 'RLIMIT_AS', '--as'),
+               ('nofile', 'RLIMIT_NOFILE', '--nofile'))
+
+    IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+    __slots__ = ('cpu', 'address_space', 'nofile', 'nice', 'ionice', 'affinity')
+
+    def __init__(self, cpu=None, address_space=None, nofile=None, nice=None,
+                 ionice=None, affinity=None):
+        if ionice is not None:
+            ioclass = type(ionice) in (list, tuple) and ionice[0] or ionice
+            if ioclass not in self.IONICE_CLASSES:
+                raise ValueError('unknown ionice class {0}'.format(ioclass))
+        self.cpu = cpu
+        self.address_space = address_space
+        self.nofile = nofile
+        self.nice = nice
+        self.ionice = ionice
+        self.affinity = affinity
+
+    def key(self):
+        """get hashable values of the settings
+
+        @return tuple
+        """
+        return tuple(type(v) is list and tuple(v) or v
+                     for v in (getattr(self, k) for k in self.__slots__))
+
+    def merge(self, other):
+        """get Resources whose settings are overridden by settings of other
+
+        @param Resources other
+        @return Resources
+        """
+        kwargs = {}
+        for k in self.__slots__:
+            v = getattr(other, k)
+            if v is None:
+                v = getattr(self, k)
+            kwargs[k] = v
+        return Resources(**kwargs)
+
+    def prepare(self, argv, wrap=False):
+        """get command arguments and preexec function which apply the settings
+
+        @param list argv command arguments
+        @param bool wrap apply all settings by wrapper commands
+        @return tuple (argv, preexec_fn), preexec_fn is None if it is not needed
+        """
+        prefix = []
+        rlimits = []
+        for attr, name, opt in self.RLIMITS:
+            limit = getattr(self, attr)
+            if limit is None:
+                continue
+            if type(limit) not in (list, tuple):
+                limit = (limit, limit)
+            if wrap:
+                prefix.append('{0}={1}:{2}'.format(opt, *limit))
+            else:
+                # resource is imported in parent, not in the child
+                rlimits.append((getattr(resource, name), tuple(limit)))
+        if prefix:
+            prefix = [self._wrapper('prlimit')] + prefix + ['--']
+        nice = self.nice
+        if nice is not None and wrap:
+            prefix += [self._wrapper('nice'), '-n', str(nice)]
+            nice = None
+        if self.ionice is not None:
+            ionice = type(self.ionice) in (list, tuple) and self.ionice or (self.ionice,)
+            prefix += [self._wrapper('ionice'), '-c', str(self.IONICE_CLASSES[ionice[0]])]
+            if len(ionice) > 1:
+                prefix += ['-n', str(ionice[1])]
+        affinity = self.affinity
+        if affinity is not None and (wrap or not hasattr(os, 'sched_setaffinity')):
+            prefix += [self._wrapper('taskset'), '-c', ','.join(str(cpu) for cpu in affinity)]
+            affinity = None
+        preexec_fn = None
+        if rlimits or nice is not None or affinity is not None:
+            def preexec_fn():
+                for res, limit in rlimits:
+                    resource.setrlimit(res, limit)
+                if nice is not None:
+                    os.nice(nice)
+                if affinity is not None:
+                    os.sched_setaffinity(0, affinity)
+        return (prefix and prefix + list(argv) or argv, preexec_fn)
+
+    def _wrapper(self, cmdname):
+        path = which(cmdname)
+        if not path:
+            raise CommandNotFound(cmdname)
+        return path
+
+    def __repr__(self):
+        return '{0}({1})'.format(self.__class__.__name__, ', '.join(
+            '{0}={1!r}'.format(k, getattr(self, k)) for k in self.__slots__
+            if getattr(self, k) is not None))
+
 # =======================
 # Command Adpater Classes
 # =======================
+class DefaultOptions(dict):
+    """Object for storing default options, which remembers the command
+       options transformed from them until it is modified
+    """
+
+    __slots__ = ('_optargs',)
+
+    def __init__(self, *args, **kwargs):
+        super(DefaultOptions, self).__init__(*args, **kwargs)
+        self._optargs = {}
+
+    def optargs(self, opt_style, exclude=()):
+        """get command options transformed from default options
+
+        @param str opt_style
+        @param tuple exclude option names not to transform
+        @return list option args
+        """
+        key = (opt_style, exclude)
+        try:
+            return self._optargs[key]
+        except KeyError:
+            pass
+        kwargs = dict((k, v) for k, v in self.items() if k not in exclude)
+        result = OptionCreator(opt_style).transform_kwargs(**kwargs)
+        self._optargs[key] = result
+        return result
+
+    def _modified(method):
+        def wrapper(self, *args, **kwargs):
+            self._optargs = {}
+            return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        return wrapper
+
+    __setitem__ = _modified(dict.__setitem__)
+    __delitem__ = _modified(dict.__delitem__)
+    update = _modified(dict.update)
+    clear = _modified(dict.clear)
+    pop = _modified(dict.pop)
+    popitem = _modified(dict.popitem)
+    setdefault = _modified(dict.setdefault)
+    del _modified
+
 class CmdConfiguration(object):
     """Object for sharing common configurations
     """
+
+    __slots__ = ('dry_run', '_default_opts', 'opt_style', 'resources')
+
     def __init__(self):
-        self.dry_run = global_config('dry_run')
+        # global_config('dry_run') is read when the command is called
+        self.dry_run = False
         self.default_opts = {}
         self.opt_style = 'posix'
+        # Resources of the command, None means no controls
+        self.resources = None
+
+    @property
+    def default_opts(self):
+        return self._default_opts
+    @default_opts.setter
+    def default_opts(self, value):
+        self._default_opts = DefaultOptions(value)
 
 class BaseCmd(object):
 
-    def __init__(self, name=None):
+    # subclasses without __slots__ have __dict__ as usual
+    __slots__ = ('name', 'conf', '__weakref__')
+
+    def __init__(self, name=None, conf=None):
         self.name = name or self.__class__.__name__.lower()
-        self.conf = CmdConfiguration()
-        DBG("Created a {}".format(repr(self)))
+        self.conf = conf is not None and conf or CmdConfiguration()
+        DBG("Created a %r", self)
 
     @property
     def opt_style(self):
@@ -319,47 +1752,220 @@ class BaseCmd(object):
 
 class ExecutableCmd(BaseCmd):
 
-    execute_kwargs = ('stdin','as_process', 'via_shell', 'with_extend_output', 'cwd')
+    execute_kwargs = ('stdin','as_process', 'via_shell', 'with_extend_output', 'cwd',
+                      'stream', 'timeout', 'stdout_to', 'stderr_to', 'stderr_tee',
+                      'input', 'resources')
+
+    __slots__ = ('_result_cache', '_single_flight')
+
+    def __init__(self, name=None, conf=None):
+        self._result_cache = None
+        self._single_flight = False
+        super(ExecutableCmd, self).__init__(name, conf)
+
+    @property
+    def result_cache(self):
+        """ResultCache for results of this command, None means no cache"""
+        return self._result_cache
+    @result_cache.setter
+    def result_cache(self, cache):
+        self._result_cache = cache
+
+    @property
+    def single_flight(self):
+        """concurrent calls with the same arguments share one execution"""
+        return self._single_flight
+    @single_flight.setter
+    def single_flight(self, value):
+        self._single_flight = value
 
     def __call__(self, *args, **kwargs):
         return self._callProcess(*args, **kwargs)
 
+    def map(self, items, max_workers=4, ordered=True, **kwargs):
+        """execute command once for every item, at most max_workers commands
+           are executed at the same time
+
+        @param iterable items arguments of every call, a tuple or list is
+                              used as arguments, a dict is used as keyword
+                              arguments, otherwise it is the only argument
+        @param int max_workers maximum number of running commands
+        @param bool ordered    return a list of results in order of items if
+                               ordered is True, otherwise a generator yields
+                               (index, result) as soon as a call is finished
+        @param dict kwargs     options of every call
+        @return list results, the result of a failed call is its
+                CommandExecutedError
+        @raise ValueError max_workers is less than 1
+
+        @example
+            # dpkg-deb --info for every package, 8 processes at most
+            infos = ucltip.Cmd('dpkg-deb').map(debs, max_workers=8, info=True)
+        """
+        if max_workers < 1:
+            raise ValueError('max_workers should be at least 1, got {0}'.format(max_workers))
+        results = self._imap(items, max_workers, kwargs)
+        if not ordered:
+            return results
+        ret = {}
+        for idx, result in results:
+            ret[idx] = result
+        return [ret[idx] for idx in range(len(ret))]
+
+    @staticmethod
+    def map_arguments(item, kwargs):
+        """get arguments of the call for a item of map
+
+        @return tuple (args, kwargs)
+        """
+        if type(item) is dict:
+            return (), dict(kwargs, **item)
+        elif type(item) in (tuple, list):
+            return item, dict(kwargs)
+        return (item,), dict(kwargs)
+
+    def _imap(self, items, max_workers, kwargs):
+        tasks = enumerate(items)
+        map_arguments = self.map_arguments
+        lock = threading.Lock()
+        done = queue.Queue()
+        stopped = []
+
+        def worker():
+            try:
+                while not stopped:
+                    with lock:
+                        try:
+                            idx, item = next(tasks)
+                        except StopIteration:
+                            break
+                    args, opts = map_arguments(item, kwargs)
+                    try:
+                        result = self(*args, **opts)
+                    except CommandExecutedError as e:
+                        result = e
+                    except Exception as e:
+                        stopped.append(e)
+                        break
+                    done.put((idx, result))
+            finally:
+                done.put(None)
+
+        # workers run with configure of the caller
+        worker = _bind_config(worker)
+        for i in range(max_workers):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+        running = max_workers
+        try:
+            while running:
+                ret = done.get()
+                if ret is None:
+                    running -= 1
+                else:
+                    yield ret
+        finally:
+            stopped.append(None)
+        if stopped[0] is not None:
+            raise stopped[0]
+
     def _callProcess(self, *args, **in_kwargs):
         # Handle optional arguments prior to calling transform_kwargs
         # otherwise these'll end up in args, which is bad.
-        kwargs = {}
-        kwargs.update(self.opts())
-        kwargs.update(in_kwargs)
+        kwargs = in_kwargs
+        _kwargs = self._pop_execute_kwargs(kwargs)
+
+        # Prepare the argument list
+        call = self.make_callargs(*args, **kwargs)
+        DBG('Builded command string:%s', call)
+        return self._dispatch(call, _kwargs)
+
+    def _pop_execute_kwargs(self, kwargs):
+        """pop arguments of execute from kwargs, default options of them
+           are used if they are not given
+
+        @param dict kwargs
+        @return dict arguments of execute
+        """
+        defaults = self.conf.default_opts
         _kwargs = {}
         for kwarg in self.execute_kwargs:
-            try:
+            if kwarg in kwargs:
                 _kwargs[kwarg] = kwargs.pop(kwarg)
-            except KeyError:
-                pass
+            elif kwarg in defaults:
+                _kwargs[kwarg] = defaults[kwarg]
+        return _kwargs
 
-        # Prepare the argument list
-        call = self.make_callargs(*args, **kwargs)
-        DBG('Builded command string:{}'.format(call))
+    def _dispatch(self, call, _kwargs):
+        """execute command arguments list, or return it by execmode
 
-        # Execute
-        mode = global_config('execmode')
-        if self.conf.dry_run or mode == 'list':
+        @param list call command arguments
+        @param dict _kwargs arguments of execute
+        """
+        conf = current_config()
+        mode = conf['execmode']
+        if self.conf.dry_run or conf['dry_run'] or mode == 'list':
             return call
         if mode == 'string':
-            return ' '.join(call)
+            return render_command(call)
+        cache = self.result_cache
+        if cache is not None and cache.cacheable(**_kwargs):
+            return self._cached_execute(cache, call, _kwargs)
+        if self.single_flight and shareable(**_kwargs):
+            return self._shared_execute(call, _kwargs)
         return self.execute(call, **_kwargs)
 
+    def _cached_execute(self, cache, call, _kwargs):
+        key = cache.make_key(call, **_kwargs)
+        result = cache.get(key, _MISSING)
+        if result is _MISSING:
+            stamp = cache.stamp()
+            if self.single_flight:
+                result = self._shared_execute(call, _kwargs)
+            else:
+                result = self.execute(call, **_kwargs)
+            cache.set(key, result, stamp)
+        return result
+
+    def _shared_execute(self, call, _kwargs):
+        return single_flight.do(execution_key(call, **_kwargs),
+                                self.execute, call, **_kwargs)
+
     def execute(self, command, stdin=None, as_process=False,
-                via_shell=False, with_extend_output=False, cwd=None):
+                via_shell=False, with_extend_output=False, cwd=None,
+                stream=False, timeout=None, stdout_to=None, stderr_to=None,
+                stderr_tee=False, input=None, resources=None):
         """execute command
 
         @param subprocess.PIPE stdin
         @param bool as_process  retrun Popen instance if as_process is True for
                                 more control
-        @param bool via_shell   use os.system instead of subprocess.call
+        @param bool via_shell   use os.system instead of subprocess.call, timeout
+                                can not be used with it and global_config('timeout')
+                                does not apply to it
         @param str   cwd       If cwd is not None, the current directory will be changed to cwd
                                 before the child is executed
+        @param bool/int stream  return a generator of output lines if stream is True,
+                                or chunks of stream bytes if stream is a number
+        @param float timeout    kill the command and the processes it created if it
+                                does not terminate in timeout seconds, the default
+                                is global_config('timeout')
+        @param str/file/int stdout_to write stdout to a path, file object or file
+                                      descriptor directly, the result is empty
+        @param str/file/int stderr_to write stderr to a path, file object or file
+                                      descriptor directly
+        @param bool/int stderr_tee keep the last 64 KB or stderr_tee bytes of stderr
+                                   written to stderr_to for the error message
+        @param bytes/str/iterable/file input data written to stdin of the command
+                                             while its output is read, or a iterable
+                                             of chunks, a file is read by the command
+                                             directly
+        @param Resources resources resource limits and priorities of the command,
+                                   which override the ones of conf and
+                                   global_config('resources')
         @return str execited result (as_process musc be False)
+        @raise CommandTimeoutError the command is timed out
 
         @example
             # the same as echo `ls -al|grep Dox`
@@ -371,50 +1977,315 @@ class ExecutableCmd(BaseCmd):
             "You can not get a Popen instance when you want to execute command in shell."
         assert not (stdin and via_shell),\
             "You can not use stdin and via_shell in the same time."
-        if global_config('via_shell') or via_shell:
-            status = os.system(' '.join(command))
+        assert not (stream and (as_process or via_shell or with_extend_output)),\
+            "You can not stream output with as_process, via_shell or with_extend_output."
+        assert not ((stdout_to or stderr_to) and via_shell),\
+            "You can not redirect output and use via_shell in the same time."
+        assert not (stdout_to is not None and stream),\
+            "You can not stream output which is redirected."
+        assert not (stderr_tee and as_process),\
+            "You can not tee stderr when you want to get a Popen instance."
+        assert not (input is not None and (stdin or as_process or via_shell)),\
+            "You can not use input with stdin, as_process or via_shell."
+        feeder = None
+        if hasattr(input, 'fileno'):
+            # the process reads the file without copying it through a pipe
+            stdin = input
+        elif input is not None:
+            stdin, feeder = subprocess.PIPE, InputFeeder(input)
+        stats = _HOOKS and ExecutionStats(self.fullname, command) or None
+        conf = current_config()
+        via_shell = conf['via_shell'] or via_shell
+        # os.system can not be timed out
+        assert not (timeout is not None and via_shell),\
+            "You can not use timeout and via_shell in the same time."
+        spawn_argv, preexec = self._prepare_resources(command, resources, conf,
+                                                      via_shell or conf['spawn'] == 'fast')
+        if via_shell:
+            status = os.system(render_command(spawn_argv, expand=True))
+            if stats is not None:
+                stats.finish(status)
             if status != 0:
-                ERR(' '.join(command))
-                raise CommandExecutedError(status)
+                ERR(render_command(command))
+                raise CommandExecutedError(status, argv=command)
             return status
         else:
-            # Start the process
-            proc = subprocess.Popen(command,
-                                    stdin=stdin,
-                                    stderr=subprocess.PIPE,
-                                    stdout=subprocess.PIPE,
-                                    cwd=cwd,
-                                    **extra
-                                    )
+            if timeout is None and not as_process:
+                timeout = conf['timeout']
+            if stream:
+                # the process is started when the first output is read, so a
+                # generator which is never iterated leaves nothing running
+                chunk_size = stream is not True and int(stream) or None
+                spawn = lambda: self._spawn(spawn_argv, preexec, conf, stdin, cwd, timeout,
+                                            stdout_to, stderr_to, stderr_tee)
+                return self._iter_output(spawn, command, chunk_size, stats, timeout, feeder)
+            proc, stderr_buffer = self._spawn(spawn_argv, preexec, conf, stdin, cwd, timeout,
+                                              stdout_to, stderr_to, stderr_tee)
             if as_process:
                 return proc
+            if stats is not None:
+                stats.spawned()
 
             # Wait for the process to return
             try:
-                stdout_value = proc.stdout.read()
-                stderr_value = proc.stderr.read()
-                status = proc.wait()
+                status, stdout_value, stderr_value = communicate(proc, stats, timeout,
+                                                                 stderr_buffer, feeder)
+            except CommandTimeoutError as e:
+                if stats is not None:
+                    stats.finish(e.status)
+                ERR(render_command(command), e.errmsg)
+                e.argv = command
+                if e.spill is not None:
+                    e.spill.seek(0)
+                raise
             finally:
-                proc.stdout.close()
-                proc.stderr.close()
-
-            if not with_extend_output:
-                if status != 0:
-                    ERR(' '.join(command), stderr_value)
-                    raise CommandExecutedError(status, stderr_value)
-                return stdout_value
+                if stderr_buffer is not None:
+                    stderr_buffer.close()
+            if stats is not None:
+                stats.finish(status)
+            return self._result(command, status, stdout_value, stderr_value,
+                                with_extend_output, stderr_buffer)
+
+    def _spawn(self, spawn_argv, preexec, conf, stdin=None, cwd=None, timeout=None,
+               stdout_to=None, stderr_to=None, stderr_tee=False):
+        """start the process of execute
+
+        @return tuple (subprocess.Popen, buffer for stderr or None)
+        """
+        stdout, stdout_file = redirect_target(stdout_to)
+        stderr, stderr_file = redirect_target(stderr_to)
+        stderr_buffer = None
+        if stderr_to is not None and stderr_tee:
+            stderr_buffer = TeeBuffer(stderr,
+                                      stderr_tee is not True and int(stderr_tee) or STDERR_TAIL_SIZE,
+                                      stderr_file is not None)
+            stderr, stderr_file = subprocess.PIPE, None
+        else:
+            stderr_buffer = stderr_capture(conf['stderr_limit'], conf['stderr_spill'])
+        try:
+            proc = subprocess.Popen(spawn_argv,
+                                    executable=self._executable(spawn_argv),
+                                    stdin=stdin,
+                                    stderr=stderr,
+                                    stdout=stdout,
+                                    cwd=cwd,
+                                    **self._popen_kwargs(timeout is not None, preexec)
+                                    )
+        except Exception:
+            if stderr_buffer is not None:
+                stderr_buffer.close()
+            raise
+        finally:
+            # the process has its own copies of redirected files
+            if stdout_file is not None:
+                stdout_file.close()
+            if stderr_file is not None:
+                stderr_file.close()
+        return proc, stderr_buffer
+
+    @property
+    def fullname(self):
+        """command name used in statistics"""
+        return self.name
+
+    def _prepare_resources(self, command, resources=None, conf=None, wrap=False):
+        """apply resource controls of the call, the command and the configure
+           to command arguments
+
+        @param list command command arguments
+        @param Resources resources resource controls of the call
+        @param dict conf current configure
+        @param bool wrap apply all controls by wrapper commands
+        @return tuple (command arguments, preexec function or None)
+        """
+        merged = (conf or current_config())['resources']
+        for r in (self.conf.resources, resources):
+            if r is not None:
+                merged = merged is not None and merged.merge(r) or r
+        if merged is None:
+            return (command, None)
+        return merged.prepare(command, wrap)
+
+    def _popen_kwargs(self, new_group=False, preexec=None):
+        """get extra keyword arguments of subprocess.Popen
+
+        @param bool new_group start the process in a new process group, so
+                              it can be killed with its children
+        @param function preexec called in the child process before exec
+        """
+        kwargs = dict(extra)
+        if os.name == 'posix' and sys.version_info[0] < 3:
+            # python ignores SIGPIPE, which is inherited by child process,
+            # python 3 restores it by default
+            kwargs['preexec_fn'] = new_group and _new_process_group or _restore_signals
+        elif os.name == 'posix' and new_group:
+            if sys.version_info >= (3, 11):
+                kwargs['process_group'] = 0
             else:
-                return (status, stdout_value)
+                kwargs['start_new_session'] = True
+        if preexec is not None:
+            before = kwargs.get('preexec_fn')
+            kwargs['preexec_fn'] = before and (lambda: (before(), preexec())) or preexec
+        if current_config()['spawn'] == 'fast':
+            # subprocess uses posix_spawn or vfork only if file descriptors
+            # are not closed and there is no preexec_fn, fork copies the page
+            # tables of parent, which is slow if parent is large.
+            kwargs['close_fds'] = False
+        return kwargs
+
+    def _executable(self, command):
+        """get absolute path of the program, which saves the PATH search of exec
+
+        @return str path, None if it is not found
+        """
+        executable = not extra and which(command[0]) or None
+        if executable and os.path.isabs(executable):
+            return executable
+
+    def _result(self, command, status, stdout_value, stderr_value,
+                with_extend_output=False, stderr_buffer=None):
+        """get result of executed command
+
+        @param TailBuffer stderr_buffer buffer stderr_value is from, which
+                                        tells if it is truncated
+        @return str stdout_value, or tuple (status, stdout_value) if
+                with_extend_output is True
+        """
+        if status != 0 and not with_extend_output:
+            raise self._error(command, status, stderr_value, stderr_buffer)
+        spill = getattr(stderr_buffer, 'spill', None)
+        if spill is not None:
+            spill.close()
+        if not with_extend_output:
+            return stdout_value
+        else:
+            return (status, stdout_value)
+
+    def _error(self, command, status, stderr_value, stderr_buffer=None):
+        """log a failed execution and make its CommandExecutedError"""
+        ERR(render_command(command), stderr_value)
+        spill = getattr(stderr_buffer, 'spill', None)
+        if spill is not None:
+            spill.seek(0)
+        return CommandExecutedError(status, stderr_value, command, spill,
+                                    getattr(stderr_buffer, 'truncated', False))
+
+    def _iter_output(self, spawn, command, chunk_size=None, stats=None, timeout=None,
+                     feeder=None):
+        """yield output lines or chunks of a process, only the tail of stderr
+           is kept for the error message
+
+        @param function spawn start the process, returns (subprocess.Popen,
+                              buffer for stderr or None)
+        @param list command
+        @param int chunk_size yield lines if chunk_size is None
+        @param ExecutionStats stats
+        @param float timeout
+        @param InputFeeder feeder write its data to stdin of the process
+        """
+        proc, stderr_buffer = spawn()
+        if stats is not None:
+            stats.spawned()
+        stderr = stderr_buffer is not None and stderr_buffer or TailBuffer(STDERR_TAIL_SIZE)
+        pending = b''
+        # pieces of a partial line, they are joined once the line ends, so a
+        # long line is not copied for every read
+        partial = []
+        deadline = timeout is not None and time.time() + timeout or None
+        pipes = [pipe for pipe in (proc.stdout, proc.stderr) if pipe is not None]
+        feed = feeder is not None and (proc.stdin, feeder) or None
+        try:
+            try:
+                for pipe, data in iter_pipes(pipes, deadline=deadline, feed=feed):
+                    if pipe is proc.stderr:
+                        stderr.write(data)
+                        continue
+                    if stats is not None:
+                        stats.got_output()
+                        stats.stdout_bytes += len(data)
+                    if chunk_size:
+                        pending += data
+                        end = len(pending) - len(pending) % chunk_size
+                        for i in range(0, end, chunk_size):
+                            yield pending[i:i + chunk_size]
+                        pending = pending[end:]
+                    else:
+                        lines = data.split(b'\n')
+                        partial.append(lines.pop())
+                        if lines:
+                            lines[0] = b''.join(partial[:-1]) + lines[0]
+                            partial = partial[-1:]
+                        for line in lines:
+                            yield line + b'\n'
+                if partial:
+                    pending = b''.join(partial)
+            except PipeTimeout:
+                if partial:
+                    pending = b''.join(partial)
+                terminate_process(proc)
+                status = wait_process(proc, stats)
+                if stats is not None:
+                    stats.stderr_bytes = stderr.size
+                    stats.finish(status)
+                ERR(render_command(command), stderr.getvalue())
+                if stderr.spill is not None:
+                    stderr.spill.seek(0)
+                raise CommandTimeoutError(timeout, status, stderr.getvalue(), pending,
+                                          command, stderr.spill, stderr.truncated)
+            if pending:
+                yield pending
+            status = wait_process(proc, stats)
+        finally:
+            for pipe in pipes:
+                pipe.close()
+            if feed is not None:
+                proc.stdin.close()
+            if stderr_buffer is not None:
+                stderr_buffer.close()
+            # the consumer stopped early
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        if stats is not None:
+            stats.stderr_bytes = stderr.size
+            stats.finish(status)
+        if status != 0:
+            raise self._error(command, status, stderr.getvalue(), stderr)
+        if stderr.spill is not None:
+            stderr.spill.close()
+
+    def bind(self, *args, **kwargs):
+        """make a Plan which runs the command with the arguments many times,
+           Placeholder arguments are given every time the Plan runs
+
+        @return Plan
+        """
+        _kwargs = self._pop_execute_kwargs(kwargs)
+        return Plan(self, self.make_callargs(*args, **kwargs),
+                    placeholder_names(args, kwargs), _kwargs)
 
     def make_callargs(self, *args, **kwargs):
+        """make command arguments list, default options are overridden by
+           kwargs
+
+        @return list command arguments
+        """
         # Prepare the argument list
-        opt_args = OptionCreator(self.conf.opt_style).transform_kwargs(**kwargs)
-        ext_args = map(str, args)
+        defaults = self.conf.default_opts
+        if any(k in defaults for k in kwargs):
+            merged = dict((k, v) for k, v in defaults.items() if k not in self.execute_kwargs)
+            merged.update(kwargs)
+            opt_args = OptionCreator(self.conf.opt_style).transform_kwargs(**merged)
+        else:
+            opt_args = defaults.optargs(self.conf.opt_style, self.execute_kwargs)
+            if kwargs:
+                opt_args = opt_args + OptionCreator(self.conf.opt_style).transform_kwargs(**kwargs)
+        ext_args = [str(arg) for arg in args]
         args = ext_args + opt_args
         return [self.name] + args
 
     def __repr__(self):
-        opt = self.opts() and ' ' + " ".join(OptionCreator(self.conf.opt_style).transform_kwargs(**self.opts())) or ''
+        opt = self.opts() and ' ' + " ".join(self.conf.default_opts.optargs(self.conf.opt_style)) or ''
         return "{0} object bound '{1}{2}'".format(self.__class__.__name__, self.name, opt)
 
 class Cmd(ExecutableCmd):
@@ -426,6 +2297,8 @@ class Cmd(ExecutableCmd):
                       are `posix`, `gnu`, `java`, the default is posix
     """
 
+    __slots__ = ()
+
     def __init__(self, name=None):
         super(Cmd, self).__init__(name)
         if not cmdexists(self.name):
@@ -442,8 +2315,10 @@ class SubCmd(ExecutableCmd):
         - opt_style -- delegate to Parent Command opt_style (read only)
     """
 
+    __slots__ = ('parent',)
+
     def __init__(self, name, parent=None):
-        super(SubCmd, self).__init__(name)
+        super(SubCmd, self).__init__(name, parent is not None and parent.conf or None)
         self.parent = parent
 
         # data delegations
@@ -457,12 +2332,17 @@ class SubCmd(ExecutableCmd):
         """
         self.conf = self.parent.conf
 
+    @property
+    def fullname(self):
+        return self.parent and '{0} {1}'.format(self.parent.name, self.name) or self.name
+
     def make_callargs(self, *args, **kwargs):
         if not self.parent:
             raise RequireParentCmd
-        if self.parent.subcmd_prefix and not self.parent.subcmd_prefix in self.name:
-            self.name = self.parent.subcmd_prefix + self.name
         args = super(SubCmd, self).make_callargs(*args, **kwargs)
+        prefix = self.parent.subcmd_prefix
+        if prefix and not prefix in self.name:
+            args[0] = prefix + self.name
         args.insert(0, self.parent.name)
         return args
 
@@ -475,6 +2355,10 @@ class CmdDispatcher(BaseCmd):
         - opt_style - A string to indicate what options style be used , avaliable values are
           `posix`, `gnu`, `java`, the default is posix
     """
+
+    # class of sub command objects
+    subcmd_class = SubCmd
+
     def __init__(self, name=None):
         self.subcmd_prefix = None
         self._subcmds = {}
@@ -488,24 +2372,204 @@ class CmdDispatcher(BaseCmd):
         return self.getsubcmd(name)
 
     def getsubcmd(self, name):
-        return self._subcmds.setdefault(name, SubCmd(name, self))
+        """get a sub command, it is created at the first time
+
+        @param str name
+        @return SubCmd
+        """
+        try:
+            return self._subcmds[name]
+        except KeyError:
+            return self._subcmds.setdefault(name, self.subcmd_class(name, self))
 
     def __repr__(self):
         return "{0} object bound '{1}'".format(self.__class__.__name__, self.name)
 
+class LazyCmd(object):
+    """Object for creating a Cmd or CmdDispatcher at the first time it is
+       called or its attribute is accessed, CommandNotFound raises then if
+       the command does not exist
+
+    Keyword Arguments:
+        - name -- A string indicating the command name
+        - cls -- Cmd or CmdDispatcher class, the default is Cmd
+    """
+
+    __slots__ = ('_name', '_cls', '_obj')
+
+    def __init__(self, name, cls=None):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_cls', cls or Cmd)
+        object.__setattr__(self, '_obj', None)
+
+    def resolve(self):
+        """get the bound object, it is created at the first time
+
+        @return Cmd or CmdDispatcher
+        """
+        obj = self._obj
+        if obj is None:
+            obj = self._cls(self._name)
+            object.__setattr__(self, '_obj', obj)
+        return obj
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.resolve(), name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        if self._obj is None:
+            return "{0} object of '{1}'".format(self.__class__.__name__, self._name)
+        return repr(self._obj)
+
+# ============
+# Plan Classes
+# ============
+class Placeholder(object):
+    """Object for an argument of a Plan which is given when the Plan runs
+
+    Keyword Arguments:
+        - name -- A string indicating the name of the value
+    """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        assert '\0' not in name, 'name of placeholder can not include NUL'
+        self.name = name
+
+    def __str__(self):
+        # marker in the built arguments, NUL can not be in real arguments
+        return '\0{0}\0'.format(self.name)
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, self.name)
+
+def placeholder_names(args, kwargs):
+    """get names of placeholders, the ones in positional arguments come
+       first in order, then the ones in options sorted by option name
+
+    @param tuple args
+    @param dict kwargs
+    @return tuple names
+    """
+    values = list(args)
+    for k in sorted(kwargs):
+        v = kwargs[k]
+        values.extend(type(v) in (list, tuple) and v or [v])
+    names = []
+    for v in values:
+        if isinstance(v, Placeholder) and v.name not in names:
+            names.append(v.name)
+    return tuple(names)
+
+class Plan(object):
+    """Object for a command arguments list built once, only values of
+       placeholders are replaced when it runs, default options of the
+       command are bound when the Plan is made
+
+    Keyword Arguments:
+        - cmd -- Cmd or SubCmd object
+        - argv -- A list indicating command arguments includes placeholders
+        - names -- A tuple indicating names of placeholders
+        - kwargs -- A dict indicating arguments of execute
+    """
+
+    __slots__ = ('cmd', 'names', '_template', '_kwargs')
+
+    def __init__(self, cmd, argv, names, kwargs=None):
+        for name in names:
+            assert name not in cmd.execute_kwargs, \
+                '{0} is an argument of execute'.format(name)
+        index = dict((name, i) for i, name in enumerate(names))
+        template = []
+        for arg in argv:
+            parts = arg.split('\0')
+            if len(parts) == 1:
+                template.append(arg)
+            else:
+                # odd parts are names of placeholders
+                template.append(tuple(index[part] if i % 2 else part
+                                      for i, part in enumerate(parts)))
+        self.cmd = cmd
+        self.names = names
+        self._template = tuple(template)
+        self._kwargs = kwargs or {}
+
+    def run(self, *values, **kwargs):
+        """run the command with values of placeholders
+
+        @param values values of placeholders in order of names
+        @param kwargs values of placeholders by name, or arguments of execute
+        @return output of the command, same as calling the command
+        """
+        names = self.names
+        if len(values) > len(names):
+            raise TypeError('{0} placeholders but {1} values'.format(len(names), len(values)))
+        values = [str(v) for v in values]
+        for name in names[len(values):]:
+            if name not in kwargs:
+                raise TypeError('value of placeholder {0} is missing'.format(name))
+            values.append(str(kwargs.pop(name)))
+        _kwargs = self._kwargs
+        if kwargs:
+            for k in kwargs:
+                if k not in self.cmd.execute_kwargs:
+                    raise TypeError('unexpected argument {0}'.format(k))
+            _kwargs = dict(_kwargs, **kwargs)
+        call = []
+        for arg in self._template:
+            if type(arg) is tuple:
+                arg = ''.join(values[part] if type(part) is int else part for part in arg)
+            call.append(arg)
+        return self.cmd._dispatch(call, _kwargs)
+
+    __call__ = run
+
+    def __repr__(self):
+        argv = (''.join('{' + self.names[part] + '}' if type(part) is int else part
+                        for part in arg) if type(arg) is tuple else arg
+                for arg in self._template)
+        return "{0} object of '{1}'".format(self.__class__.__name__, ' '.join(argv))
+
 # ============
 # Pipe Classes
 # ============
 class PipeError(Exception):
-    pass
+
+    def __init__(self, errmsg=None, statuses=None):
+        self.errmsg = errmsg
+        # exit status of every command
+        self.statuses = statuses
+
+    def __str__(self):
+        return str(self.errmsg)
 
 class Pipe(object):
     """Object for handling command pipeline
+
+    the output pipe of a command is closed in parent after it is handed to
+    the next command, so data flows between commands directly and a command
+    gets SIGPIPE when the next command exits.
     """
 
     def __init__(self):
-        # last process
-        self._last_proc = None
+        # processes of commands in order
+        self._procs = []
+        # exit status of every command, available after wait
+        self.statuses = []
+        # stderr of every command, only the tail is kept except the last one
+        self.stderr_values = []
+        self._output = None
+
+    @property
+    def _last_proc(self):
+        return self._procs and self._procs[-1] or None
 
     def add(self, cmd, *args, **opts):
         """add command arguments in this pipe
@@ -517,24 +2581,514 @@ class Pipe(object):
         if type(cmd) is str and not opts:
             cmd = Cmd(cmd)
 
+        last_proc = self._last_proc
         opts['as_process'] = True
-        if self._last_proc:
-            opts['stdin'] = self._last_proc.stdout
-        self._last_proc =  cmd(*args, **opts)
+        stdin = None
+        if last_proc:
+            # the command reads nothing if output of the last one is redirected
+            stdin = last_proc.stdout or open(os.devnull, 'rb')
+            opts['stdin'] = stdin
+        try:
+            self._procs.append(cmd(*args, **opts))
+        finally:
+            if stdin is not None:
+                # the pipe is owned by the next command now
+                stdin.close()
 
     def wait(self):
-        """Wait for the process to terminate.  Returns returncode attribute.
+        """Wait for all processes to terminate, output of the last command
+           and stderr of every command are read in the meantime.
+
+        PipeError raises if any command failed (pipefail), but a command
+        killed by SIGPIPE is not failed if it is not the last one, because
+        the next command just stopped reading.
+
+        @return int returncode of the last command
         """
         if not self._last_proc:
             raise PipeError("theres is no any process inside")
-        status = self._last_proc.wait()
-        if status != 0:
-            raise PipeError()
-        return status
+        if self._output is None:
+            self._communicate()
+        statuses = self.statuses
+        sigpipe = -getattr(signal, 'SIGPIPE', 0)
+        if [s for s in statuses[:-1] if s not in (0, sigpipe)] or statuses[-1] != 0:
+            raise PipeError('pipe failed, exit status: {0}'.format(statuses), statuses)
+        return statuses[-1]
+
+    def _communicate(self):
+        last_proc = self._last_proc
+        bufs = {}
+        # stdout or stderr redirected by stdout_to or stderr_to is None
+        if last_proc.stdout is not None and not last_proc.stdout.closed:
+            bufs[last_proc.stdout] = ChunkBuffer()
+        for proc in self._procs:
+            if proc.stderr is not None:
+                bufs[proc.stderr] = proc is last_proc and ChunkBuffer() or TailBuffer()
+        try:
+            for pipe, data in iter_pipes(list(bufs)):
+                bufs[pipe].write(data)
+        finally:
+            for pipe in bufs:
+                pipe.close()
+        self.statuses = [proc.wait() for proc in self._procs]
+        self.stderr_values = [proc.stderr in bufs and bufs[proc.stderr].getvalue() or b''
+                              for proc in self._procs]
+        self._output = io.BytesIO(last_proc.stdout in bufs and bufs[last_proc.stdout].getvalue() or b'')
+        self._errput = io.BytesIO(self.stderr_values[-1])
 
     def __getattr__(self, k):
-        if self._last_proc and k in ('status', 'stdout', 'stderr'):
+        if k in ('status', 'stdout', 'stderr'):
+            if self.__dict__.get('_output') is not None:
+                return {'status': self.statuses[-1],
+                        'stdout': self._output,
+                        'stderr': self._errput}[k]
+            procs = self.__dict__.get('_procs')
+            if procs and k != 'status':
+                return getattr(procs[-1], k)
+            return None
+        raise AttributeError(k)
+
+# =================
+# Coprocess Classes
+# =================
+class CoprocessError(Exception):
+
+    def __init__(self, errmsg=None, status=None):
+        self.errmsg = errmsg
+        self.status = status
+
+    def __str__(self):
+        return str(self.errmsg)
+
+class CoprocessTimeout(CoprocessError):
+    pass
+
+def _to_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode('utf-8')
+
+class _PipeReader(object):
+    """Object for reading stdout of a process with timeout, stderr is drained
+       and requests are written to stdin in the meantime, only the tail of
+       stderr is kept
+    """
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.stderr = TailBuffer()
+        # chunks of stdout are joined once a response is complete
+        self._chunks = []
+        self._size = 0
+        self._stdout = proc.stdout.fileno()
+        self._fds = [self._stdout, proc.stderr.fileno()]
+        # stdin is written only when it is ready, so a process writing its
+        # output before it reads all of the request does not block us
+        self._infd = proc.stdin.fileno()
+        if fcntl is not None:
+            fcntl.fcntl(self._infd, fcntl.F_SETFL,
+                        fcntl.fcntl(self._infd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        # InputFeeder objects of requests are not fully written
+        self._feeders = []
+        self._poller = None
+        if hasattr(select, 'poll'):
+            self._poller = select.poll()
+            for fd in self._fds:
+                self._poller.register(fd, select.POLLIN | select.POLLPRI)
+
+    def send(self, data):
+        """write data to stdin while responses are read"""
+        self._feeders.append(InputFeeder(data))
+        if self._poller is not None and len(self._feeders) == 1:
+            self._poller.register(self._infd, select.POLLOUT)
+
+    def read_until(self, marker, timeout=None):
+        """read data until marker, the marker is consumed but not returned"""
+        deadline = timeout is not None and time.time() + timeout or None
+        keep = len(marker) - 1
+        # every chunk is searched once, with the tail of the previous one
+        offset, tail, i = 0, b'', 0
+        while True:
+            while i < len(self._chunks):
+                window = tail + self._chunks[i]
+                idx = window.find(marker)
+                if idx >= 0:
+                    return self._take(offset - len(tail) + idx, len(marker))
+                offset += len(self._chunks[i])
+                tail = keep and window[-keep:] or b''
+                i += 1
+            self._fill(deadline)
+
+    def read_exactly(self, size, timeout=None):
+        """read size bytes"""
+        deadline = timeout is not None and time.time() + timeout or None
+        while self._size < size:
+            self._fill(deadline)
+        return self._take(size, 0)
+
+    def _take(self, end, skip):
+        """remove data before end and skip bytes after it from the buffer
+
+        @return str data before end
+        """
+        buf = len(self._chunks) == 1 and self._chunks[0] or b''.join(self._chunks)
+        rest = buf[end + skip:]
+        self._chunks = rest and [rest] or []
+        self._size = len(rest)
+        return buf[:end]
+
+    def _ready(self, remain):
+        """wait for fds which can be read, and stdin if it can be written
+
+        @return list fds
+        """
+        try:
+            if self._poller is None:
+                ready = select.select(self._fds, self._feeders and [self._infd] or [], [], remain)
+                return ready[0] + ready[1]
+            return [fd for fd, event in
+                    self._poller.poll(remain is not None and remain * 1000 or None)]
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def _feed(self):
+        """write requests to stdin until it is full"""
+        while self._feeders:
+            if not self._feeders[0].feed(self._infd):
+                return
+            self._feeders.pop(0)
+        if self._poller is not None:
+            self._poller.unregister(self._infd)
+
+    def _fill(self, deadline):
+        while True:
+            remain = None
+            if deadline is not None:
+                remain = deadline - time.time()
+                if remain <= 0:
+                    raise CoprocessTimeout('no response from {0} in time'.format(self.proc.pid))
+            for fd in self._ready(remain):
+                if fd == self._infd:
+                    self._feed()
+                    continue
+                data = os.read(fd, CHUNK_SIZE)
+                if fd != self._stdout:
+                    if data:
+                        self.stderr.write(data)
+                    else:
+                        self._fds.remove(fd)
+                        if self._poller is not None:
+                            self._poller.unregister(fd)
+                elif data:
+                    self._chunks.append(data)
+                    self._size += len(data)
+                    return
+                else:
+                    raise CoprocessError('process exited, Err Msg:{0}'.format(
+                                         self.stderr.getvalue()), self.proc.wait())
+
+class LineFraming(object):
+    """Framing of request and response are one line
+    """
+
+    def encode(self, request):
+        return request + b'\n'
+
+    def decode(self, reader, timeout=None):
+        return reader.read_until(b'\n', timeout)
+
+class SentinelFraming(object):
+    """Framing of response ends with a sentinel line, which is printed by
+       a command sent after every request
+
+    @example
+        # sh
+        SentinelFraming('echo __END__', '__END__')
+        # sqlite3
+        SentinelFraming('.print __END__', '__END__')
+    """
+
+    def __init__(self, command, sentinel):
+        self.command = _to_bytes(command)
+        self.sentinel = _to_bytes(sentinel) + b'\n'
+
+    def encode(self, request):
+        return request + b'\n' + self.command + b'\n'
+
+    def decode(self, reader, timeout=None):
+        return reader.read_until(self.sentinel, timeout)
+
+class ShellFraming(object):
+    """Framing of a POSIX shell, a response is the exit status and output of
+       a command, which is followed by a sentinel line printed by the shell,
+       the output needs not end with a new line
+    """
+
+    def __init__(self, sentinel=None):
+        self.sentinel = _to_bytes(sentinel or
+                                  'ucltip-' + binascii.hexlify(os.urandom(8)).decode('ascii'))
+
+    def encode(self, request):
+        return request + b"\nprintf '\\n%s %d\\n' " + self.sentinel + b' "$?"\n'
+
+    def decode(self, reader, timeout=None):
+        output = reader.read_until(b'\n' + self.sentinel + b' ', timeout)
+        return (int(reader.read_until(b'\n', timeout)), output)
+
+class Coprocess(object):
+    """Object for sending many requests to a persistent process of a command
+
+    the process is started at the first request, and restarted if it exited
+    or timed out.
+
+    Keyword Arguments:
+        - cmd -- Cmd, SubCmd or command name
+        - args -- arguments of the command
+        - framing -- object encodes requests and decodes responses, the
+          default is LineFraming
+        - health_request -- request sent by check, None means only to check
+          the process is alive
+        - health_response -- expected response of health_request, None means
+          any response
+        - opts -- options of the command
+
+    @example
+        sh = ucltip.Coprocess('sh', framing=ucltip.SentinelFraming('echo __END__', '__END__'))
+        sh.request('expr 1 + 1')
+    """
+
+    def __init__(self, cmd, args=(), framing=None, health_request=None,
+                 health_response=None, **opts):
+        if type(cmd) is str:
+            cmd = Cmd(cmd)
+        self.cmd = cmd
+        self.args = args
+        self.opts = opts
+        self.framing = framing or LineFraming()
+        self.health_request = health_request
+        self.health_response = health_response
+        self.proc = None
+        # how many times the process is restarted
+        self.restarts = 0
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def request(self, data, timeout=None):
+        """send a request and read its response
+
+        @param str data request
+        @param float timeout seconds to wait for the response, the process
+                             is killed if it is timed out
+        @return str response
+        """
+        with self._lock:
+            if not self.alive():
+                self._start()
+            return self._request(data, timeout)
+
+    def check(self, timeout=None):
+        """check health of the process, restart it if it is not healthy
+
+        @return bool True if the process was healthy
+        """
+        with self._lock:
+            healthy = self.alive()
+            if healthy and self.health_request is not None:
+                try:
+                    response = self._request(self.health_request, timeout)
+                except CoprocessError:
+                    healthy = False
+                else:
+                    healthy = self.health_response is None or \
+                              response == _to_bytes(self.health_response)
+            if not healthy:
+                self._start()
+            return healthy
+
+    def close(self, timeout=1):
+        """close stdin of the process and wait for it to exit, it is killed
+           after timeout seconds
+        """
+        with self._lock:
+            if self.proc is None:
+                return
             try:
-                return getattr(self._last_proc, k)
-            except AttributeError:
-                return None
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+            deadline = time.time() + timeout
+            while self.proc.poll() is None and time.time() < deadline:
+                time.sleep(0.01)
+            self._kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _start(self):
+        if self.proc is not None:
+            self._kill()
+            self.restarts += 1
+        self.proc = self.cmd(*self.args, as_process=True, stdin=subprocess.PIPE, **self.opts)
+        self._reader = _PipeReader(self.proc)
+
+    def _request(self, data, timeout):
+        try:
+            self._reader.send(self.framing.encode(_to_bytes(data)))
+            return self.framing.decode(self._reader, timeout)
+        except (IOError, OSError) as e:
+            self._kill()
+            raise CoprocessError('failed to send request:{0}'.format(e), self.proc.returncode)
+        except CoprocessError:
+            self._kill()
+            raise
+
+    def _kill(self):
+        proc = self.proc
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        for pipe in (proc.stdin, proc.stdout, proc.stderr):
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+
+class CoprocessPool(object):
+    """Object for a pool of Coprocess objects of the same command, a request
+       is sent to a idle one
+
+    the arguments are the same as Coprocess, except size is number of
+    processes.
+    """
+
+    def __init__(self, cmd, args=(), size=2, **kwargs):
+        if type(cmd) is str:
+            cmd = Cmd(cmd)
+        self.coprocesses = [Coprocess(cmd, args, **kwargs) for i in range(size)]
+        self._idle = queue.Queue()
+        for coproc in self.coprocesses:
+            self._idle.put(coproc)
+
+    def request(self, data, timeout=None):
+        """send a request to a idle process and read its response
+
+        @return str response
+        """
+        coproc = self._idle.get()
+        try:
+            return coproc.request(data, timeout)
+        finally:
+            self._idle.put(coproc)
+
+    def check(self, timeout=None):
+        """check health of all processes
+
+        @return int number of unhealthy processes
+        """
+        unhealthy = 0
+        for i in range(len(self.coprocesses)):
+            coproc = self._idle.get()
+            try:
+                if coproc.proc is not None and not coproc.check(timeout):
+                    unhealthy += 1
+            finally:
+                self._idle.put(coproc)
+        return unhealthy
+
+    def close(self):
+        for coproc in self.coprocesses:
+            coproc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class BatchShell(object):
+    """Object for running many commands in one persistent shell process,
+       every command is rendered as a command string and sent to stdin of
+       the shell, so no shell or Python subprocess is started for it
+
+    commands read nothing from stdin, and their stderr is written to a
+    temporary file, which is read for the error message only if the
+    command failed.
+
+    Keyword Arguments:
+        - shell -- A string indicating the shell, the default is sh
+
+    @example
+        with ucltip.BatchShell() as sh:
+            sh.run('expr', 1, '+', 1)
+            sh.run(ucltip.Cmd('ls'), '/tmp', l=True)
+    """
+
+    def __init__(self, shell='sh'):
+        self.coprocess = Coprocess(shell, framing=ShellFraming())
+        fd, self.errfile = tempfile.mkstemp(prefix='ucltip-')
+        os.close(fd)
+        self._redirect = ' </dev/null 2>' + shell_quote(self.errfile)
+        self._lock = threading.Lock()
+
+    def run(self, cmd, *args, **opts):
+        """run a command in the shell
+
+        @param cmd Cmd, SubCmd or command name
+        @param args command arguments
+        @param opts command options, and with_extend_output and timeout,
+                    which are the same as the ones of Cmd, the shell is
+                    killed if the command is timed out
+        @return str output, or tuple (status, output) if with_extend_output
+                is True
+        """
+        with_extend_output = opts.pop('with_extend_output', False)
+        timeout = opts.pop('timeout', None)
+        if type(cmd) is str:
+            argv = [cmd] + [str(arg) for arg in args] + OptionCreator().transform_kwargs(**opts)
+        else:
+            argv = cmd.make_callargs(*args, **opts)
+        with self._lock:
+            status, output = self.coprocess.request(render_command(argv) + self._redirect, timeout)
+            if status != 0 and not with_extend_output:
+                ERR(render_command(argv))
+                errmsg, truncated = self._errmsg()
+                raise CommandExecutedError(status, errmsg, argv, truncated=truncated)
+        if not with_extend_output:
+            return output
+        return (status, output)
+
+    def _errmsg(self):
+        """read the tail of stderr of the last command
+
+        @return tuple (errmsg, truncated)
+        """
+        limit = current_config()['stderr_limit']
+        with open(self.errfile, 'rb') as f:
+            if limit is None:
+                # all of stderr is kept
+                return (f.read(), False)
+            f.seek(0, io.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - limit))
+            return (f.read(), size > limit)
+
+    def close(self):
+        self.coprocess.close()
+        try:
+            os.remove(self.errfile)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- encoding=utf8 -*-
+#
+# Author 2011 Hsin-Yi Chen
+"""asyncio counterparts of ucltip command classes (Python 3.5 or later)
+
+Calling these objects returns a coroutine, so one event loop can keep many
+commands in flight
+
+    git = ucltip.aio.AsyncCmdDispatcher('git')
+    log = await git.log(n=1)
+
+The module contains the following public classes:
+
+    - AsyncCmd -- asyncio version of Cmd
+    - AsyncSubCmd -- asyncio version of SubCmd
+    - AsyncCmdDispatcher -- asyncio version of CmdDispatcher
+"""
+
+__all__ = ['AsyncCmd',
+           'AsyncSubCmd',
+           'AsyncCmdDispatcher']
+
+import asyncio
+import signal
+import ucltip
+
+# in-flight executions shared by identical concurrent calls
+_INFLIGHT = {}
+
+async def _drain(stream, buf, stats=None):
+    while True:
+        data = await stream.read(ucltip.CHUNK_SIZE)
+        if not data:
+            break
+        if stats is not None:
+            stats.got_output()
+        buf.write(data)
+
+async def _feed(writer, feeder):
+    try:
+        for chunk in feeder:
+            writer.write(chunk)
+            await writer.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # the process does not read all input
+        pass
+    finally:
+        writer.close()
+
+def _signal(proc, sig, group):
+    if group:
+        ucltip._signal_group(proc, sig)
+    elif proc.returncode is None:
+        try:
+            proc.send_signal(sig)
+        except ProcessLookupError:
+            pass
+
+async def _terminate(proc, grace=ucltip.KILL_GRACE, group=True):
+    _signal(proc, signal.SIGTERM, group)
+    try:
+        await asyncio.wait_for(proc.wait(), grace)
+    except asyncio.TimeoutError:
+        pass
+    _signal(proc, signal.SIGKILL, group)
+    await proc.wait()
+
+class AsyncExecutableCmd(object):
+    """Mixin makes a ExecutableCmd awaitable
+    """
+
+    __slots__ = ()
+
+    async def __call__(self, *args, **kwargs):
+        return await self._callProcess(*args, **kwargs)
+
+    async def _dispatch(self, call, _kwargs):
+        # also makes runs of Plan objects of this command awaitable
+        result = super()._dispatch(call, _kwargs)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    async def map(self, items, max_workers=4, ordered=True, **kwargs):
+        """execute command once for every item, at most max_workers commands
+           are executed at the same time
+
+        the parameters are the same as ExecutableCmd.map, but a list of
+        (index, result) in order of finishing is returned if ordered is False.
+        """
+        if max_workers < 1:
+            raise ValueError('max_workers should be at least 1, got {0}'.format(max_workers))
+        semaphore = asyncio.Semaphore(max_workers)
+        finished = []
+
+        async def call(idx, item):
+            args, opts = self.map_arguments(item, kwargs)
+            async with semaphore:
+                try:
+                    result = await self(*args, **opts)
+                except ucltip.CommandExecutedError as e:
+                    result = e
+            finished.append((idx, result))
+            return result
+
+        results = await asyncio.gather(*[call(idx, item) for idx, item in enumerate(items)])
+        return ordered and results or finished
+
+    async def _cached_execute(self, cache, call, _kwargs):
+        key = cache.make_key(call, **_kwargs)
+        result = cache.get(key, ucltip._MISSING)
+        if result is ucltip._MISSING:
+            stamp = cache.stamp()
+            if self.single_flight:
+                result = await self._shared_execute(call, _kwargs)
+            else:
+                result = await self.execute(call, **_kwargs)
+            cache.set(key, result, stamp)
+        return result
+
+    async def _shared_execute(self, call, _kwargs):
+        loop = asyncio.get_event_loop()
+        key = (id(loop),) + ucltip.execution_key(call, **_kwargs)
+        future = _INFLIGHT.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.execute(call, **_kwargs))
+            _INFLIGHT[key] = future
+            future.add_done_callback(lambda f: _INFLIGHT.pop(key, None))
+        # a cancelled caller does not cancel the execution shared by others
+        return await asyncio.shield(future)
+
+    async def execute(self, command, stdin=None, as_process=False,
+                      via_shell=False, with_extend_output=False, cwd=None,
+                      stream=False, timeout=None, stdout_to=None, stderr_to=None,
+                      stderr_tee=False, input=None, resources=None):
+        """execute command without blocking the event loop
+
+        the parameters are the same as ExecutableCmd.execute, but
+        stream is not supported.
+
+        @return str execited result, or asyncio.subprocess.Process
+                if as_process is True
+        """
+        assert not (as_process and via_shell),\
+            "You can not get a Process instance when you want to execute command in shell."
+        assert not (stdin and via_shell),\
+            "You can not use stdin and via_shell in the same time."
+        assert not stream, "You can not stream output of a AsyncCmd."
+        assert not ((stdout_to or stderr_to) and via_shell),\
+            "You can not redirect output and use via_shell in the same time."
+        assert not (stderr_tee and as_process),\
+            "You can not tee stderr when you want to get a Process instance."
+        assert not (input is not None and (stdin or as_process or via_shell)),\
+            "You can not use input with stdin, as_process or via_shell."
+        feeder = None
+        if hasattr(input, 'fileno'):
+            stdin = input
+        elif input is not None:
+            stdin, feeder = asyncio.subprocess.PIPE, ucltip.InputFeeder(input)
+        stats = ucltip._HOOKS and ucltip.ExecutionStats(self.fullname, command) or None
+        conf = ucltip.current_config()
+        via_shell = conf['via_shell'] or via_shell
+        assert not (timeout is not None and via_shell),\
+            "You can not use timeout and via_shell in the same time."
+        spawn_argv, preexec = self._prepare_resources(command, resources, conf,
+                                                      via_shell or conf['spawn'] == 'fast')
+        if via_shell:
+            proc = await asyncio.create_subprocess_shell(ucltip.render_command(spawn_argv, expand=True))
+            status = await proc.wait()
+            if stats is not None:
+                stats.finish(status)
+            if status != 0:
+                ucltip.ERR(ucltip.render_command(command))
+                raise ucltip.CommandExecutedError(status, argv=command)
+            return status
+
+        if timeout is None and not as_process:
+            timeout = conf['timeout']
+        stdout, stdout_file = ucltip.redirect_target(stdout_to)
+        stderr, stderr_file = ucltip.redirect_target(stderr_to)
+        out = ucltip.ChunkBuffer()
+        err = ucltip.stderr_capture(conf['stderr_limit'], conf['stderr_spill']) \
+            or ucltip.ChunkBuffer()
+        tee = None
+        if stderr_to is not None and stderr_tee:
+            err = tee = ucltip.TeeBuffer(stderr,
+                                         stderr_tee is not True and int(stderr_tee) or ucltip.STDERR_TAIL_SIZE,
+                                         stderr_file is not None)
+            stderr, stderr_file = asyncio.subprocess.PIPE, None
+        try:
+            proc = await asyncio.create_subprocess_exec(*spawn_argv,
+                                                        executable=self._executable(spawn_argv),
+                                                        stdin=stdin,
+                                                        stdout=stdout,
+                                                        stderr=stderr,
+                                                        cwd=cwd,
+                                                        **self._popen_kwargs(timeout is not None,
+                                                                             preexec))
+        except Exception:
+            if tee is not None:
+                tee.close()
+            raise
+        finally:
+            if stdout_file is not None:
+                stdout_file.close()
+            if stderr_file is not None:
+                stderr_file.close()
+        if as_process:
+            return proc
+        if stats is not None:
+            stats.spawned()
+        tasks = [_drain(stream, buf, stream is proc.stdout and stats or None) for stream, buf in
+                 ((proc.stdout, out), (proc.stderr, err)) if stream is not None]
+        if feeder is not None:
+            tasks.append(_feed(proc.stdin, feeder))
+        # nothing is left to read when output is redirected, so the process
+        # is waited for with the same timeout
+        tasks.append(proc.wait())
+        readers = asyncio.gather(*tasks)
+        try:
+            await asyncio.wait_for(asyncio.shield(readers), timeout)
+        except asyncio.TimeoutError:
+            await _terminate(proc)
+            try:
+                await asyncio.wait_for(readers, ucltip.KILL_GRACE)
+            except asyncio.TimeoutError:
+                pass
+            self._finish_stats(stats, proc.returncode, out, err)
+            ucltip.ERR(ucltip.render_command(command), err.getvalue())
+            spill = getattr(err, 'spill', None)
+            if spill is not None:
+                spill.seek(0)
+            raise ucltip.CommandTimeoutError(timeout, proc.returncode,
+                                             err.getvalue(), out.getvalue(), command,
+                                             spill, getattr(err, 'truncated', False))
+        except BaseException:
+            # the call is cancelled or reading failed, the process is started
+            # in its own group only if timeout is given
+            await _terminate(proc, group=timeout is not None)
+            readers.cancel()
+            try:
+                await readers
+            except (asyncio.CancelledError, Exception):
+                pass
+            raise
+        finally:
+            if tee is not None:
+                tee.close()
+        await proc.wait()
+        self._finish_stats(stats, proc.returncode, out, err)
+        return self._result(command, proc.returncode, out.getvalue(), err.getvalue(),
+                            with_extend_output, err)
+
+    def _finish_stats(self, stats, status, out, err):
+        # resource usage is not recorded, asyncio waits for the process
+        if stats is not None:
+            stats.stdout_bytes = out.size
+            stats.stderr_bytes = getattr(err, 'size', 0)
+            stats.finish(status)
+
+class AsyncCmd(AsyncExecutableCmd, ucltip.Cmd):
+    """asyncio version of Cmd
+    """
+
+    __slots__ = ()
+
+class AsyncSubCmd(AsyncExecutableCmd, ucltip.SubCmd):
+    """asyncio version of SubCmd
+    """
+
+    __slots__ = ()
+
+class AsyncCmdDispatcher(ucltip.CmdDispatcher):
+    """asyncio version of CmdDispatcher, its sub commands are AsyncSubCmd
+    """
+    subcmd_class = AsyncSubCmd